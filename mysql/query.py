@@ -1,13 +1,40 @@
+"""
+    Sends random queries to the employees test DB to generate some metrics. There are three modes:
+    trickle (the default) sends a select every 0-60 seconds, and load sends a mix of selects and
+    inserts at a target rate from a pool of worker threads, each with its own connection, then
+    reports the rate achieved and the latency percentiles. In load mode queries are scheduled
+    open-loop i.e. at the target rate regardless of how long the DB takes to respond, and their
+    latency is measured from when they were scheduled, so a slow DB shows up as high latency
+    rather than as a lower request rate. e.g.
+    python mysql/query.py --mode load --qps 500 --workers 16 --duration 300 --insert-ratio 0.1
+    replay sends the queries from the mysql_slow points written by telegraf/query_mysql.py, or
+    from a slow log file, with the same timing as they were originally run (optionally sped up)
+    and reports how closely the replay kept to the original timing and latencies. e.g.
+    python mysql/query.py --mode replay --replay-file mysql_slow.txt --speed 2
+"""
 import random
 import time
 import os
-import subprocess
+import argparse
+import threading
+import warnings
+import datetime
+import sys
 import MySQLdb
-
-first_names = [line.strip() for line in open('mysql/db_entries/first_names.txt')]
-last_names = [line.strip() for line in open('mysql/db_entries/last_names.txt')]
-dept_names = [line.strip() for line in open('mysql/db_entries/dept_names.txt')]
-titles = [line.strip() for line in open('mysql/db_entries/titles.txt')]
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+entries_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_entries')
+first_names = [line.strip() for line in open(os.path.join(entries_dir, 'first_names.txt'))]
+last_names = [line.strip() for line in open(os.path.join(entries_dir, 'last_names.txt'))]
+dept_names = [line.strip() for line in open(os.path.join(entries_dir, 'dept_names.txt'))]
+title_names = [line.strip() for line in open(os.path.join(entries_dir, 'titles.txt'))]
 
 statements = ['select','insert']
 database = 'employees'
@@ -23,63 +50,29 @@ titles=['emp_no','title','from_date','to_date']
 
 table_cols = [current_dept_emp,departments,dept_emp,dept_emp_latest_date,dept_manager,employees,salaries,titles]
 table_names = ['current_dept_emp','departments','dept_emp','dept_emp_latest_date','dept_manager','employees','salaries','titles']
-
-def getRandomEmpNo():
-    return random.randint(10001,499999)
-
-def getRandomDeptNo():
-    return 'd00' + str(random.randint(1,9))
-
-def getRandomDeptName():
-    return random.choice(dept_names)
-
-def getRandomFirstName():
-    return random.choice(first_names)
-
-def getRandomLastName():
-    return random.choice(last_names)
-
-def getRandomGender():
-    return random.choice(['M','F'])
-
-def getRandomTitle():
-    return random.choice(titles)
-
-def getRandomFromDate():
-    return getRandomDate('1985-01-01','2002-08-01','%Y-%m-%d',random.random())
-    
-def getRandomToDate():
-    return getRandomDate('1985-03-01','9999-01-01','%Y-%m-%d',random.random())
-
-def getRandomBirthDate():
-    return getRandomDate('1952-02-01','1965-02-01','%Y-%m-%d',random.random())
-
-def getRandomHireDate():
-    return getRandomDate('1985-01-01','2000-01-28','%Y-%m-%d',random.random())
-
-def getRandomSalary():
-    return random.randint(38623,158220)
-
-def getRandomDate(start, end, format, rand):
-    stime = time.mktime(time.strptime(start, format))
-    etime = time.mktime(time.strptime(end, format))
-
-    ptime = stime + rand*(etime - stime)
-
-    return time.strftime(format, time.localtime(ptime))
-
-rand_functions = { 'emp_no': getRandomEmpNo,
-                  'dept_no': getRandomDeptNo,
-                'dept_name': getRandomDeptName,
-               'first_name': getRandomFirstName,
-                'last_name': getRandomLastName,
-                  'gender' : getRandomGender,
-                    'title': getRandomTitle,
-                'from_date': getRandomFromDate,
-                  'to_date': getRandomToDate,
-               'birth_date': getRandomBirthDate,
-                'hire_date': getRandomHireDate,
-                   'salary': getRandomSalary
+# current_dept_emp and dept_emp_latest_date are views so can't be inserted into
+insert_tables = [i for i, name in enumerate(table_names) if name not in ['current_dept_emp','dept_emp_latest_date']]
+
+def dateRange(start, end):
+    """ Returns the range of a date column as day numbers, see date.toordinal """
+    return (datetime.datetime.strptime(start, '%Y-%m-%d').toordinal(),
+            datetime.datetime.strptime(end, '%Y-%m-%d').toordinal(),
+            datetime.date.fromordinal)
+
+# The random values for each column are drawn from a range of integers, then looked up in a list or
+# converted to a date if needed
+column_ranges = { 'emp_no': (10001, 499999, None),
+                 'dept_no': (1, 9, lambda x: 'd00' + str(x)),
+               'dept_name': (0, len(dept_names) - 1, dept_names.__getitem__),
+              'first_name': (0, len(first_names) - 1, first_names.__getitem__),
+               'last_name': (0, len(last_names) - 1, last_names.__getitem__),
+                  'gender': (0, 1, ['M','F'].__getitem__),
+                   'title': (0, len(title_names) - 1, title_names.__getitem__),
+               'from_date': dateRange('1985-01-01','2002-08-01'),
+                 'to_date': dateRange('1985-03-01','9999-01-01'),
+              'birth_date': dateRange('1952-02-01','1965-02-01'),
+               'hire_date': dateRange('1985-01-01','2000-01-28'),
+                  'salary': (38623, 158220, None)
 }
 
 column_types = { 'emp_no': 'string',
@@ -96,80 +89,489 @@ column_types = { 'emp_no': 'string',
                  'salary': 'value'
 }
 
-
-def getRandomQuery():
-    query = "select "
-
-    # Choose random table to query
-    table = random.randint(0,len(table_cols)-1)
-
-    # Choose random fields from that table to query
-    chosen_table_cols = random.sample(table_cols[table],random.randint(1,len(table_cols[table])))
-
-    # Randomly choose whether to include a join
-    if random.randint(0,1):
+def findJoins():
+    """ Returns a list for each table of what can be joined to it from each table. The entry for a table
+        that can be joined is a tuple of the fields common to both tables that can be joined on, and the
+        fields unique to the joining table. The entry is None if the tables can't be joined """
+    joins = []
+    for cols in table_cols:
+        table_joins = []
+        for join_cols in table_cols:
+            join_on = sorted(set(cols).intersection(join_cols).intersection(['emp_no','dept_no']))
+            unique_cols = sorted(set(join_cols) - set(cols))
+            table_joins.append((join_on, unique_cols) if join_on and unique_cols else None)
+        joins.append(table_joins)
+    return joins
+
+table_joins = findJoins()
+insert_templates = dict((table, "insert ignore into " + database + "." + table_names[table] + " (" + ", ".join(table_cols[table]) +
+                         ") values (" + ", ".join(['%s']*len(table_cols[table])) + ")") for table in insert_tables)
+
+# Random values are generated this many at a time
+BATCH_SIZE = 4096
+
+class QueryGenerator(object):
+    """ Generates random queries on the employees DB. Each query is returned as a template with %s
+        placeholders and a list of values to be bound to them by cursor.execute, and the templates are
+        cached so that the same query shape is only built once. The random values for each column are
+        generated in batches (with numpy if it is available). If seed is given the same queries are
+        generated each time """
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.numpy_random = numpy.random.RandomState(seed) if numpy is not None else None
+        self.values = dict((x, []) for x in column_ranges)
+        self.templates = {}
+
+    def getRandomValue(self, col_name):
+        values = self.values[col_name]
+        if not values:
+            low, high, convert = column_ranges[col_name]
+            if self.numpy_random is not None:
+                values = self.numpy_random.randint(low, high + 1, BATCH_SIZE).tolist()
+            else:
+                rand = self.random.random
+                span = high - low + 1
+                values = [low + int(span*rand()) for i in range(BATCH_SIZE)]
+            if convert is not None:
+                values = [convert(x) for x in values]
+            self.values[col_name] = values
+        return values.pop()
+
+    def getRandomQuery(self):
+        rand = self.random
+
+        # Choose random table to query, and random fields from that table to query
+        table = rand.randrange(len(table_cols))
+        chosen_table_cols = tuple(rand.sample(table_cols[table], rand.randint(1, len(table_cols[table]))))
+
+        # Randomly choose whether to include a join, and if so a random table to join to. Only join
+        # if there are fields to join on and unique fields in joining table
+        join = None
+        if rand.randint(0,1):
+            join_table = rand.randrange(len(table_cols))
+            join = (join_table,)
+            if table_joins[table][join_table] is not None:
+                join_on, join_table_cols = table_joins[table][join_table]
+                join = (join_table, tuple(rand.sample(join_table_cols, rand.randint(1, len(join_table_cols)))), rand.choice(join_on))
+
+        # Randomly choose whether to include a where clause. If field is a string, check for db entries
+        # that are equal to a random string, if it is a date or number check for entries > or < than a random value
+        where = None
+        params = []
+        if rand.randint(0,1):
+            col_name = rand.choice(table_cols[table])
+            where = (col_name, '=' if column_types[col_name] == 'string' else rand.choice(['<','>']))
+            params.append(self.getRandomValue(col_name))
+
+        key = (table, chosen_table_cols, join, where)
+        query = self.templates.get(key)
+        if query is None:
+            query = self.templates[key] = buildQuery(*key)
+        return query, params
+
+    def getRandomInsert(self):
+        # Choose random table (not a view) to insert a row of random values into. The row may clash with an
+        # existing key or not match a foreign key, insert ignore skips the row in this case
+        table = self.random.choice(insert_tables)
+        return insert_templates[table], [self.getRandomValue(col_name) for col_name in table_cols[table]]
+
+    def getRandomStatement(self, insert_ratio):
+        if self.random.random() < insert_ratio:
+            return ('insert',) + self.getRandomInsert()
+        return ('select',) + self.getRandomQuery()
+
+def buildQuery(table, chosen_table_cols, join, where):
+    """ Returns the template for a select from the table, see QueryGenerator.getRandomQuery """
+    if join is not None:
         # If a join is used, fields must also specify the table they're referring to
-        joined_chosen_table_cols = [table_names[table] + '.' + s for s in chosen_table_cols]
-        query += ", ".join(joined_chosen_table_cols)
-
-        # Choose a random table to join to
-        join_table = random.randint(0,len(table_cols)-1)
-
-        # Find field common to both fields that can be joined on
-        join_on = list(set(table_cols[table]).intersection(table_cols[join_table]).intersection(['emp_no','dept_no']))
-
-        # Find fields unique to joining field
-        join_table_cols = set(table_cols[join_table]) - set(table_cols[table]) # Cols unique to joining table
-
-        # Only join if there are fields to join on and unique fields in joining table
-        if join_on and join_table_cols:
-            # Choose random fields from the join table to query
-            chosen_join_table_cols = random.sample(join_table_cols,random.randint(1,len(join_table_cols)))
-
-            # Prepend the join table to each field
-            joined_chosen_join_table_cols = [table_names[join_table] + '.' + s for s in chosen_join_table_cols]
-            query += ", " + ", ".join(joined_chosen_join_table_cols)
-
+        query = "select " + ", ".join(table_names[table] + '.' + s for s in chosen_table_cols)
+        if len(join) > 1:
+            join_table, chosen_join_table_cols, chosen_join_on = join
+            query += ", " + ", ".join(table_names[join_table] + '.' + s for s in chosen_join_table_cols)
         query += " from " + database + "." + table_names[table]
-
-        # Finish join only if there are fields to join on and unique fields in joining table
-        if join_on and join_table_cols:
-            # Choose a field to join on
-            chosen_join_on = random.choice(join_on)
-            query += " join " + database + "." + table_names[join_table] + " on " + table_names[table] + "." + chosen_join_on + " = " + table_names[join_table] + "." + chosen_join_on
+        if len(join) > 1:
+            query += (" join " + database + "." + table_names[join_table] + " on " + table_names[table] + "." + chosen_join_on +
+                      " = " + table_names[join_table] + "." + chosen_join_on)
     else:
         # Simple query without join
-        query += ", ".join(chosen_table_cols) + " from " + database + "." + table_names[table]
+        query = "select " + ", ".join(chosen_table_cols) + " from " + database + "." + table_names[table]
 
-    # Randomly choose whether to include a where clause
-    if random.randint(0,1):
-        # Choose a random field to 'WHERE' on
-        col_name = random.choice(table_cols[table])
-
-        # If field is a string, check for db entries that are equal to a random string
-        if column_types[col_name] == 'string':
-            query += " where " + table_names[table] + "." + col_name + " = '" + str(rand_functions[col_name]()) + "'"
-        # If field if a date or number, check for db entries > or < than a random value
-        else:
-            operation = random.choice(["<",">"])
-            query += " where " + table_names[table] + "." + col_name + " " + operation + " '" + str(rand_functions[col_name]()) + "'"
-
-    query += ";" 
-    print query
+    if where is not None:
+        query += " where " + table_names[table] + "." + where[0] + " " + where[1] + " %s"
     return query
 
-
-# To send many queries asynchronously
-FNULL = open(os.devnull, 'w')
-users = ["reader"]
-while True:
-    user = random.choice(users)
-    subprocess.Popen(["mysql", "-u" + user,"-p" + user,"-e" + getRandomQuery() + ";"], stdout=FNULL)
-    time.sleep(60*random.random())
-
-# To send one query after another synchronously
-#db = MySQLdb.connect(user="root",passwd="Password!1")
-#cur = db.cursor()
-#while True:
-#    cur.execute(getRandomQuery())
-#db.close()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',default='localhost')
+    parser.add_argument('--port',default=3306,type=int)
+    parser.add_argument('--user',default='reader')
+    parser.add_argument('--password',default='reader')
+    parser.add_argument('--mode',default='trickle',choices=['trickle','load','replay'])
+    parser.add_argument('--qps',default=10.0,type=float)
+    parser.add_argument('--workers',default=4,type=int)
+    parser.add_argument('--duration',default=60.0,type=float)
+    parser.add_argument('--insert-ratio',default=0.0,type=float)
+    parser.add_argument('--arrivals',default='poisson',choices=['poisson','uniform'])
+    parser.add_argument('--seed',default=None,type=int)
+    parser.add_argument('--replay-file')
+    parser.add_argument('--speed',default=1.0,type=float)
+    parser.add_argument('--replay-writes',action='store_true')
+    args = parser.parse_args()
+
+    # Inserts that are ignored raise warnings, which would be printed for every query
+    warnings.simplefilter('ignore', MySQLdb.Warning)
+
+    connect_args = { 'host': args.host, 'port': args.port, 'user': args.user, 'passwd': args.password }
+    generator = QueryGenerator(args.seed)
+    if args.mode == 'trickle':
+        run_trickle(connect_args, generator)
+    elif args.mode == 'replay':
+        if args.replay_file is None:
+            parser.error('--replay-file is required with --mode replay')
+        run_replay(connect_args, load_replay_records(args.replay_file), args.workers, args.speed, args.replay_writes)
+    else:
+        run_load(connect_args, generator, args.qps, args.workers, args.duration, args.insert_ratio, args.arrivals)
+
+def run_trickle(connect_args, generator):
+    """ Sends a select every 0-60 seconds forever, reconnecting if the connection is lost """
+    db = None
+    while True:
+        try:
+            if db is None:
+                db = MySQLdb.connect(**connect_args)
+            query, params = generator.getRandomQuery()
+            print(query + ' ' + str(params))
+            cursor = db.cursor()
+            cursor.execute(query, params)
+            cursor.fetchall()
+        except MySQLdb.OperationalError as e:
+            print('Query failed - ' + str(e))
+            db = None
+        except MySQLdb.Error as e:
+            print('Query failed - ' + str(e))
+        time.sleep(60*generator.random.random())
+
+class LoadStats(object):
+    """ The latencies and errors of the statements run by the load workers, for each statement type """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict((x, []) for x in statements)
+        self.service_times = dict((x, []) for x in statements)
+        self.errors = dict((x, 0) for x in statements)
+
+    def add(self, statement, latency, service_time, error):
+        with self.lock:
+            if error:
+                self.errors[statement] += 1
+            else:
+                self.latencies[statement].append(latency)
+                self.service_times[statement].append(service_time)
+
+def run_load(connect_args, generator, qps, workers, duration, insert_ratio, arrivals):
+    """ Schedules statements at an average rate of qps for duration seconds, either evenly spaced or
+        as a Poisson process, and runs them on a pool of worker threads each with its own connection.
+        The scheduler doesn't wait for the workers, so if the DB can't keep up the statements queue up
+        and their latency (measured from when they were scheduled) goes up. Prints a report at the end """
+    pending = queue.Queue()
+    stats = LoadStats()
+    threads = [threading.Thread(target=run_load_worker, args=(connect_args, pending, stats)) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    scheduled = start
+    sent = 0
+    while scheduled < start + duration:
+        now = time.time()
+        if scheduled > now:
+            time.sleep(scheduled - now)
+        pending.put((scheduled,) + generator.getRandomStatement(insert_ratio))
+        sent += 1
+        scheduled += generator.random.expovariate(qps) if arrivals == 'poisson' else 1.0/qps
+    backlog = pending.qsize()
+
+    for thread in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print_load_report(stats, sent, backlog, elapsed, qps)
+
+def run_load_worker(connect_args, pending, stats):
+    """ Runs statements from the pending queue until it gets None, reconnecting if the connection is lost """
+    db = None
+    while True:
+        item = pending.get()
+        if item is None:
+            break
+        scheduled, statement, query, params = item
+        started = time.time()
+        error = False
+        try:
+            if db is None:
+                db = MySQLdb.connect(**connect_args)
+                db.autocommit(True)
+            cursor = db.cursor()
+            cursor.execute(query, params)
+            cursor.fetchall()
+        except MySQLdb.OperationalError:
+            error = True
+            db = None
+        except MySQLdb.Error:
+            error = True
+        finished = time.time()
+        stats.add(statement, finished - scheduled, finished - started, error)
+    if db is not None:
+        db.close()
+
+def percentile(values, p):
+    """ Returns the p'th percentile of a sorted list of values by the nearest rank method """
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, max(0, int(round(p/100.0*len(values))) - 1))]
+
+def print_load_report(stats, sent, backlog, elapsed, qps):
+    completed = sum(len(x) for x in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    print('Sent %d statements in %.1fs, target %.1f/s, achieved %.1f/s, %d errors, %d still queued when sending stopped'
+          % (sent, elapsed, qps, (completed + errors)/elapsed, errors, backlog))
+    print('%-8s %8s %8s %10s %10s %10s %10s %10s' % ('', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'svc p99 ms'))
+    for statement in statements:
+        latencies = sorted(stats.latencies[statement])
+        service_times = sorted(stats.service_times[statement])
+        print('%-8s %8d %8d %10.2f %10.2f %10.2f %10.2f %10.2f'
+              % (statement, len(latencies), stats.errors[statement], percentile(latencies, 50)*1000, percentile(latencies, 90)*1000,
+                 percentile(latencies, 99)*1000, percentile(latencies, 100)*1000, percentile(service_times, 99)*1000))
+
+def load_replay_records(path):
+    """ Returns a list of the queries to replay from the file, sorted by start time. The file can have
+        mysql_slow points in line protocol (as written by telegraf/query_mysql.py, or exported from
+        InfluxDB) or be a slow log file. Each query is a tuple of the start time in seconds, user_host,
+        DB, SQL text and the original query time in seconds """
+    if is_line_protocol_file(path):
+        records = load_line_protocol_records(path)
+    else:
+        records = load_slow_log_records(path)
+    records.sort(key=lambda x: x[0])
+    return records
+
+def is_line_protocol_file(path):
+    """ Returns whether the file has line protocol rather than being a slow log file, going by whichever
+        comes first of a mysql_slow point and the start of a slow log entry. An export from influx_inspect
+        starts with '#' and CREATE DATABASE lines, and can have points of other measurements before the
+        mysql_slow ones, so the first line isn't enough """
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'mysql_slow,') or line.startswith(b'mysql_slow '):
+                return True
+            if line.startswith(b'# Time:') or line.startswith(b'# User@Host:'):
+                return False
+    return False
+
+def load_line_protocol_records(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            # Skips other measurements, and the '#' comment and CREATE DATABASE lines of an influx_inspect export
+            if not line.startswith('mysql_slow,') and not line.startswith('mysql_slow '):
+                continue
+            measurement, tags, fields, timestamp = parse_line_protocol(line)
+            if 'sql_text' not in fields:
+                continue
+            if timestamp is not None:
+                start = timestamp/1e9
+            else:
+                start = seconds_since_epoch(datetime.datetime.strptime(fields['start_time'][:19], '%Y-%m-%d %H:%M:%S'))
+            records.append((start, fields.get('user_host', ''), fields.get('db') or None, fields['sql_text'],
+                            parse_timedelta(fields.get('query_time', '0:00:00'))))
+    return records
+
+def load_slow_log_records(path):
+    """ Reads the slow log file with the slow log parser in telegraf/query_mysql.py, which is only
+        imported when it is needed """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'telegraf'))
+    import query_mysql
+
+    records = []
+    db = None
+    with open(path, 'rb') as f:
+        for entries, offset in query_mysql.read_slow_log_entries(f, 0, os.path.getsize(path) + 1):
+            for entry in entries:
+                values = query_mysql.parse_slow_log_entry(entry, None)
+                if values is None:
+                    continue
+                # The DB is only logged when it changes
+                if values[6] is not None:
+                    db = values[6]
+                records.append((seconds_since_epoch(values[0]), values[1], db, values[10], values[2].total_seconds()))
+    return records
+
+def seconds_since_epoch(value):
+    return (value - datetime.datetime(1970, 1, 1)).total_seconds()
+
+def parse_timedelta(value):
+    """ Returns the number of seconds in a timedelta formatted by str e.g. '0:00:01.500000' or '1 day, 2:00:00' """
+    days = 0
+    if ',' in value:
+        days, value = value.split(',')
+        days = int(days.split()[0])
+    hours, minutes, seconds = value.strip().split(':')
+    return days*86400 + int(hours)*3600 + int(minutes)*60 + float(seconds)
+
+LINE_PROTOCOL_UNESCAPE = {'n': '\n', 'r': '\r'}
+
+def parse_line_protocol(line):
+    """ Parses a line of Influx line protocol. Returns the measurement, a dictionary of the tags, a
+        dictionary of the fields and the timestamp in ns (None if there isn't one) """
+    line = line.rstrip('\r\n')
+    position = [0]
+
+    def read_until(stops, quoted=False):
+        chars = []
+        i = position[0]
+        while i < len(line) and (quoted or line[i] not in stops) and not (quoted and line[i] == '"'):
+            if line[i] == '\\' and i + 1 < len(line):
+                i += 1
+                chars.append(LINE_PROTOCOL_UNESCAPE.get(line[i], line[i]))
+            else:
+                chars.append(line[i])
+            i += 1
+        position[0] = i
+        return ''.join(chars)
+
+    measurement = read_until(', ')
+    tags = {}
+    while position[0] < len(line) and line[position[0]] == ',':
+        position[0] += 1
+        key = read_until('=')
+        position[0] += 1
+        tags[key] = read_until(', ')
+
+    fields = {}
+    while position[0] < len(line) and line[position[0]] in ', ':
+        position[0] += 1
+        key = read_until('=')
+        position[0] += 1
+        if line[position[0]:position[0] + 1] == '"':
+            position[0] += 1
+            fields[key] = read_until('', quoted=True)
+            position[0] += 1
+        else:
+            value = read_until(', ')
+            if value.endswith('i'):
+                fields[key] = int(value[:-1])
+            elif value in ['t', 'T', 'true', 'True', 'TRUE', 'f', 'F', 'false', 'False', 'FALSE']:
+                fields[key] = value[0] in 'tT'
+            else:
+                fields[key] = float(value)
+        if line[position[0]:position[0] + 1] == ' ':
+            break
+
+    timestamp = line[position[0]:].strip()
+    return measurement, tags, fields, int(timestamp) if timestamp else None
+
+READ_ONLY_STATEMENTS = ['select', 'show', 'explain', 'describe', 'desc', 'with']
+
+def run_replay(connect_args, records, workers, speed, replay_writes):
+    """ Replays the queries with the same time between them as when they were originally run, divided
+        by speed. Each original user_host is given one of the worker threads (each with its own connection)
+        so the queries from one client are run in order, on the same connection. Only statements that don't
+        change any data are replayed unless replay_writes is set. Prints a report at the end """
+    skipped = 0
+    replay = []
+    for record in records:
+        sql_text = record[3].strip()
+        keyword = sql_text.lstrip('(').split(None, 1)[0].lower() if sql_text else ''
+        if sql_text.startswith('administrator command:') or not (replay_writes or keyword in READ_ONLY_STATEMENTS):
+            skipped += 1
+        else:
+            replay.append(record)
+    if not replay:
+        print('No queries to replay, %d skipped' % skipped)
+        return
+
+    results = []
+    lock = threading.Lock()
+    pending = [queue.Queue() for i in range(workers)]
+    threads = [threading.Thread(target=run_replay_worker, args=(connect_args, x, results, lock)) for x in pending]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    assigned = {}
+    first = replay[0][0]
+    start = time.time()
+    for record in replay:
+        scheduled = start + (record[0] - first)/speed
+        now = time.time()
+        if scheduled > now:
+            time.sleep(scheduled - now)
+        worker = assigned.setdefault(record[1], len(assigned) % workers)
+        pending[worker].put((scheduled, record))
+
+    for x in pending:
+        x.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print_replay_report(results, len(records), skipped, len(assigned), elapsed, (replay[-1][0] - first)/speed)
+
+def run_replay_worker(connect_args, pending, results, lock):
+    """ Runs queries from the pending queue until it gets None, switching DB if the query was originally run on
+        a different DB, and reconnecting if the connection is lost. Adds the time each query was scheduled for,
+        the time it started, the time it took and its original record to results """
+    db = None
+    current_db = None
+    while True:
+        item = pending.get()
+        if item is None:
+            break
+        scheduled, record = item
+        started = time.time()
+        error = False
+        try:
+            if db is None:
+                db = MySQLdb.connect(**connect_args)
+                db.autocommit(True)
+                current_db = None
+            if record[2] and record[2] != current_db:
+                db.select_db(record[2])
+                current_db = record[2]
+            cursor = db.cursor()
+            cursor.execute(record[3])
+            cursor.fetchall()
+        except MySQLdb.OperationalError:
+            error = True
+            db = None
+        except MySQLdb.Error:
+            error = True
+        finished = time.time()
+        with lock:
+            results.append((scheduled, started, finished - started, record, error))
+    if db is not None:
+        db.close()
+
+def print_replay_report(results, total, skipped, clients, elapsed, intended):
+    errors = sum(1 for x in results if x[4])
+    lags = sorted(x[1] - x[0] for x in results)
+    originals = sorted(x[3][4] for x in results if not x[4])
+    replayed = sorted(x[2] for x in results if not x[4])
+    deltas = sorted(x[2] - x[3][4] for x in results if not x[4])
+    on_time = sum(1 for x in lags if x < 0.01)
+
+    print('Replayed %d of %d queries from %d clients in %.1fs (%.1fs intended), %d skipped, %d errors'
+          % (len(results), total, clients, elapsed, intended, skipped, errors))
+    print('%.1f%% started within 10ms of their scheduled time' % (100.0*on_time/len(lags)))
+    print('%-22s %10s %10s %10s %10s' % ('', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, values in [('schedule lag', lags), ('original query time', originals),
+                         ('replay query time', replayed), ('replay - original', deltas)]:
+        print('%-22s %10.2f %10.2f %10.2f %10.2f' % (name, percentile(values, 50)*1000, percentile(values, 90)*1000,
+                                                     percentile(values, 99)*1000, percentile(values, 100)*1000))
+
+if __name__ == '__main__':
+    main()
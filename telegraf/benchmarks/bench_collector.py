@@ -0,0 +1,283 @@
+"""
+    End-to-end benchmark of query_mysql.py against the fake server in fake_mysqldb.py, so the collector
+    can be measured without a MariaDB server. For each number of rows (the number of blocking session
+    pairs, slow log entries and users the fake server returns), runs the script's main() as the exec
+    plugin would and reports the best run time, the time taken by each collector, the line protocol
+    bytes written per second and the peak memory allocated (measured by tracemalloc in a separate run,
+    or the process's maximum RSS on Python 2). The collectors run concurrently, so their times overlap
+    and include time spent waiting for each other to release the GIL.
+
+    The output is also checked byte-for-byte against the golden files in benchmarks/golden, so that
+    changes to the encoder or the fetch path can't silently change what is written. It is checked for
+    each of the sets of query_mysql.py options in GOLDEN_CASES, against a new fake server each time.
+    For these runs the clock is frozen, and the mysql_collector points, which hold timings, are left
+    out. Cases whose output depends on earlier runs (counter deltas and rates, changes-only output and
+    the slow log file offset) are run more than once, keeping the state, and the last run is checked. The
+    collectors write streamed results a chunk at a time, so the lines are sorted by measurement
+    (keeping their order within each) to compare them independently of how the collectors' chunks
+    interleave. Use --update-golden to regenerate the golden files after an intended change to the
+    output. Exits with status 1 if the output doesn't match.
+
+    Usage: python telegraf/benchmarks/bench_collector.py [--rows 10,1000,100000] [--users N] [--repeat 3]
+                                                         [--update-golden]
+                                                         [query_mysql.py options, e.g. --blocking-mode chains]
+
+    The users aren't streamed, so their output is held in memory until the collector finishes. --users sets
+    the number of users separately from the rows, e.g. --users 10 to see how the memory use of the
+    streamed collectors alone grows with the rows.
+
+    Options not recognised are passed on to query_mysql.py. The golden files are for the options in
+    GOLDEN_CASES, so the output isn't checked if any are given.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fake_mysqldb
+fake_mysqldb.install(None)
+
+import query_mysql
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+GOLDEN_FILE = os.path.join(GOLDEN_DIR, 'collector.json')
+# The full output is kept for sizes up to this, so that a mismatch can be shown line by line
+GOLDEN_TEXT_MAX_ROWS = 10
+
+# The name, query_mysql.py options and number of runs, the last of which is checked, for each set of
+# options the output is checked for. {slow_log_file} is replaced with the path of the fake server's
+# slow log file, which is written after the first run. Its first entry is bigger than the
+# --slow-log-max-bytes of slow_log_file_oversized, so it is skipped by the second run of that case
+GOLDEN_CASES = [('default', [], 1),
+                ('chains', ['--blocking-mode', 'chains'], 1),
+                ('digest', ['--slow-log-mode', 'digest'], 1),
+                ('slow_log_file', ['--slow-log-file', '{slow_log_file}'], 2),
+                ('slow_log_file_oversized', ['--slow-log-file', '{slow_log_file}', '--slow-log-max-bytes', '4096'], 3),
+                ('counter_fields_derived', ['--counter-fields', 'derived'], 2),
+                ('userstat_changes_only', ['--userstat-changes-only'], 2)]
+
+# The frozen clock for the checked run, and the time between the runs of a case
+GOLDEN_TIME = 1507204800.0
+GOLDEN_INTERVAL = 60
+
+class CountingStream(object):
+    """ A stream that counts the bytes written to it, and keeps them if keep is True """
+
+    def __init__(self, keep=False):
+        self.bytes = 0
+        self.data = [] if keep else None
+
+    def write(self, data):
+        self.bytes += len(data)
+        if self.data is not None:
+            self.data.append(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.data)
+
+class FrozenTime(object):
+    """ Stands in for the time module in query_mysql, with time() always returning the same value so that
+        the timestamps of the points are the same every run """
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class FixedRandom(object):
+    """ Stands in for the random module in query_mysql, with Random() returning a generator that gives the
+        same numbers every run on both Python 2 and 3, so that the slow query digest's reservoir samples
+        and so its percentiles are the same every run """
+
+    def Random(self):
+        return FixedRandom.Generator()
+
+    class Generator(object):
+
+        def __init__(self):
+            self.state = 0
+
+        def randrange(self, stop):
+            self.state = (self.state*1103515245 + 12345) % 2**31
+            return self.state % stop
+
+def run_collector(collector_args, stream):
+    """ Runs query_mysql.main() once with its output written to stream. Returns the time taken and the
+        CollectorThreads run """
+    threads = []
+    run_collectors = query_mysql.run_collectors
+
+    def record_collectors(target, collectors):
+        threads.extend(run_collectors(target, collectors))
+        return threads
+
+    argv, stdout = sys.argv, sys.stdout
+    sys.argv = ['query_mysql.py'] + collector_args
+    sys.stdout = stream
+    query_mysql.run_collectors = record_collectors
+    try:
+        start = time.time()
+        query_mysql.main()
+        elapsed = time.time() - start
+    finally:
+        sys.argv, sys.stdout = argv, stdout
+        query_mysql.run_collectors = run_collectors
+    return elapsed, threads
+
+def measure_memory(collector_args):
+    """ Returns the peak memory allocated during a run in bytes, and how it was measured """
+    if tracemalloc is None:
+        run_collector(collector_args, CountingStream())
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024, 'max RSS of process'
+    tracemalloc.start()
+    try:
+        run_collector(collector_args, CountingStream())
+        return tracemalloc.get_traced_memory()[1], 'peak traced'
+    finally:
+        tracemalloc.stop()
+
+def base_args(rows, state_dir=''):
+    """ Returns the query_mysql.py options for every run. The whole slow log is gathered in one run, and
+        the collectors don't time out, as they can take much longer than usual under tracemalloc """
+    return ['--state-dir', state_dir, '--max-rows', 'slow_queries=%d' % max(rows, 1), '--collector-timeout', '3600']
+
+def golden_output(rows, case_args, runs):
+    """ Returns the output for a golden case with the clock frozen, without the mysql_collector points """
+    server = fake_mysqldb.FakeServer(rows)
+    fake_mysqldb.install(server)
+    directory = tempfile.mkdtemp()
+    slow_log_file = os.path.join(directory, 'slow.log')
+    open(slow_log_file, 'w').close()
+    collector_args = (base_args(rows, directory if runs > 1 else '') +
+                      [x.format(slow_log_file=slow_log_file) for x in case_args])
+
+    stream = CountingStream(keep=True)
+    real_time, real_random = query_mysql.time, query_mysql.random
+    query_mysql.random = FixedRandom()
+    try:
+        for run in range(runs):
+            query_mysql.time = FrozenTime(GOLDEN_TIME - (runs - 1 - run)*GOLDEN_INTERVAL)
+            run_collector(collector_args, stream if run == runs - 1 else CountingStream())
+            server.uptime += GOLDEN_INTERVAL
+            if run == 0:
+                server.write_slow_log_file(slow_log_file)
+    finally:
+        query_mysql.time, query_mysql.random = real_time, real_random
+        shutil.rmtree(directory)
+    lines = [x for x in stream.getvalue().splitlines(True) if not x.startswith('mysql_collector,')]
+    return ''.join(sorted(lines, key=lambda x: x.split(',', 1)[0]))
+
+def check_golden(name, rows, output, golden, update):
+    """ Compares the output of the named golden case for rows against the golden files, or updates them.
+        Returns False if they don't match """
+    text_file = os.path.join(GOLDEN_DIR, 'collector_%s_%d.lp' % (name, rows))
+    digest = { 'sha256': hashlib.sha256(output.encode('utf-8')).hexdigest(), 'bytes': len(output),
+               'lines': output.count('\n') }
+    label = 'golden %s:' % name
+    if update:
+        golden.setdefault(name, {})[str(rows)] = digest
+        if not os.path.isdir(GOLDEN_DIR):
+            os.makedirs(GOLDEN_DIR)
+        if rows <= GOLDEN_TEXT_MAX_ROWS:
+            with open(text_file, 'w') as f:
+                f.write(output)
+        print('%-30s updated' % label)
+        return True
+
+    expected = golden.get(name, {}).get(str(rows))
+    if expected is None:
+        print('%-30s none for %d rows, run with --update-golden' % (label, rows))
+        return True
+    if expected == digest:
+        print('%-30s ok' % label)
+        return True
+
+    print('%-30s MISMATCH (%d bytes, %d lines, expected %d bytes, %d lines)'
+          % (label, digest['bytes'], digest['lines'], expected['bytes'], expected['lines']))
+    if os.path.exists(text_file):
+        with open(text_file) as f:
+            expected_lines = f.read().splitlines()
+        for i, (line, expected_line) in enumerate(zip(output.splitlines(), expected_lines)):
+            if line != expected_line:
+                print('  line %d:\n    got      %s\n    expected %s' % (i + 1, line, expected_line))
+                break
+    return False
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows',default='10,1000,100000')
+    parser.add_argument('--users',default=None,type=int)
+    parser.add_argument('--repeat',default=3,type=int)
+    parser.add_argument('--update-golden',action='store_true')
+    args, extra_args = parser.parse_known_args()
+
+    # The start times in the slow log file are converted to local time, like those in mysql.slow_log
+    # are in the server's time zone, so use UTC for them to match the fake server's wherever this is run
+    os.environ['TZ'] = 'UTC'
+    time.tzset()
+
+    sizes = [int(x) for x in args.rows.split(',')]
+    golden = {}
+    if os.path.exists(GOLDEN_FILE):
+        with open(GOLDEN_FILE) as f:
+            golden = json.load(f)
+
+    matched = True
+    for rows in sizes:
+        # Don't keep any state between runs, so each run is like the first
+        collector_args = base_args(rows) + extra_args
+        fake_mysqldb.install(fake_mysqldb.FakeServer(rows, args.users))
+
+        best = None
+        for i in range(args.repeat):
+            stream = CountingStream()
+            elapsed, threads = run_collector(collector_args, stream)
+            if best is None or elapsed < best[0]:
+                best = (elapsed, threads, stream.bytes)
+        elapsed, threads, output_bytes = best
+        memory, memory_method = measure_memory(collector_args)
+
+        print('rows:          %d' % rows)
+        print('best of %d:     %.3f s' % (args.repeat, elapsed))
+        for thread in threads:
+            print('  %-20s %.3f s' % (thread.name, thread.duration or 0))
+        print('output:        %d bytes, %.1f MB/s of line protocol' % (output_bytes, output_bytes / elapsed / 1e6))
+        print('memory:        %.1f MB (%s)' % (memory / 1e6, memory_method))
+        if extra_args or args.users is not None:
+            print('golden:        not checked, query_mysql.py options or --users given')
+        else:
+            for name, case_args, runs in GOLDEN_CASES:
+                if not check_golden(name, rows, golden_output(rows, case_args, runs), golden, args.update_golden):
+                    matched = False
+        print('')
+
+    if args.update_golden:
+        with open(GOLDEN_FILE, 'w') as f:
+            json.dump(golden, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+
+    if not matched:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+    Micro-benchmark for the line protocol encoder in query_mysql.py. Encodes batches of rows shaped like
+    the mysql_slow rows from gather_slow_queries (with SQL text containing commas, spaces, quotes and
+    newlines that must be escaped, and some NULL fields) and reports the throughput. The output is
+    written to a stream that only counts the bytes, so the time is that of the encoder alone.
+
+    Usage: python telegraf/benchmarks/bench_encoder.py [--rows 100000] [--repeat 5]
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# The encoder doesn't need a DB or the journal, so allow the benchmark to be run on a machine
+# without MySQLdb or the systemd python module installed, using the same stand-ins as bench_collector.py
+import fake_mysqldb
+fake_mysqldb.install(None)
+
+import query_mysql
+
+class CountingStream(object):
+    """ A stream that counts the bytes and writes written to it and discards them """
+
+    def __init__(self):
+        self.bytes = 0
+        self.writes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+def make_slow_log_rows(n):
+    """ Returns n rows with the same columns and types as those selected from mysql.slow_log """
+    start = datetime.datetime(2017, 10, 5, 12, 0, 0)
+    rows = []
+    for i in range(n):
+        sql_text = ('SELECT e.first_name, e.last_name, "x y"\nFROM employees.employees e\n'
+                    'WHERE e.emp_no IN (%d, %d, %d) AND e.last_name = \'O\\\'Neil, J=%d\';' % (i, i + 1, i + 2, i))
+        rows.append((start + datetime.timedelta(microseconds=i),
+                     'reader[reader] @ localhost []',
+                     datetime.timedelta(seconds=1, microseconds=i % 1000000),
+                     datetime.timedelta(microseconds=i % 1000),
+                     i % 100,
+                     i * 10,
+                     'employees' if i % 10 else None,
+                     0,
+                     0,
+                     1,
+                     sql_text))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows',default=100000,type=int)
+    parser.add_argument('--repeat',default=5,type=int)
+    args = parser.parse_args()
+
+    rows = make_slow_log_rows(args.rows)
+    stdout = sys.stdout
+    best = None
+    try:
+        for i in range(args.repeat):
+            sys.stdout = stream = CountingStream()
+            start = time.time()
+            query_mysql.print_influx_line_protocol('mysql_slow', ['host'], ['bench.example.com'],
+                                                   query_mysql.SLOW_LOG_FIELD_KEYS, rows,
+                                                   query_mysql.SLOW_LOG_FIELD_TYPES, ts_field='start_time')
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        sys.stdout = stdout
+
+    print('rows:          %d' % args.rows)
+    print('best of %d:     %.3f s' % (args.repeat, best))
+    print('throughput:    %.0f rows/s' % (args.rows / best))
+    print('               %.1f MB/s of line protocol' % (stream.bytes / best / 1e6))
+    print('output writes: %d' % stream.writes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+    A stand-in for the MySQLdb module, serving canned result sets for the queries made by the gather_*
+    functions in query_mysql.py, so that the collector can be benchmarked and its output checked without
+    a MariaDB server. A FakeServer generates the result sets for a given number of rows (blocking session
+    pairs, slow log entries and, unless given separately, users), which are the same every time for the
+    same number of rows.
+    install replaces MySQLdb (and systemd.journal, if it isn't installed) in sys.modules, so it must be
+    called before query_mysql is imported.
+
+    Only what query_mysql uses is implemented: connect, Connection.cursor/ping/thread_id/close, buffered
+    and unbuffered (SSCursor) cursors with execute/fetchall/fetchmany, and the Error and Warning classes.
+"""
+
+import bisect
+import datetime
+import logging
+import re
+import sys
+import types
+
+class Error(Exception):
+    """ Like MySQLdb errors, the error code and message are in e.args. As with mysqlclient on Python 3,
+        they can't be read as e[0] and e[1] """
+
+class Warning(Exception):
+    pass
+
+class OperationalError(Error):
+    pass
+
+class ProgrammingError(Error):
+    pass
+
+# The server connect returns connections to, set by install
+server = None
+
+class Connection(object):
+    next_thread_id = 1000
+
+    def __init__(self, server):
+        self.server = server
+        self.open = True
+        Connection.next_thread_id += 1
+        self.thread = Connection.next_thread_id
+
+    def cursor(self, cursorclass=None):
+        return (cursorclass or Cursor)(self)
+
+    def ping(self):
+        if not self.open:
+            raise OperationalError(2006, 'MySQL server has gone away')
+
+    def thread_id(self):
+        return self.thread
+
+    def close(self):
+        self.open = False
+
+class Cursor(object):
+    """ A buffered cursor. The rows are served from the FakeServer's result set as is, so fetching
+        them costs about as little as it can and the time measured is that of the collector """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.position = 0
+
+    def execute(self, query, params=None):
+        if not self.connection.open:
+            raise OperationalError(2006, 'MySQL server has gone away')
+        self.rows = self.connection.server.execute(query, params)
+        self.position = 0
+        return len(self.rows)
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return tuple(rows)
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return tuple(rows)
+
+    def close(self):
+        self.rows = []
+
+class SSCursor(Cursor):
+    """ An unbuffered cursor, which is the same as a buffered one for a fake server """
+
+def connect(**kwargs):
+    if server is None:
+        raise OperationalError(2003, 'Can\'t connect to MySQL server, no FakeServer installed')
+    return Connection(server)
+
+cursors = types.ModuleType('MySQLdb.cursors')
+cursors.Cursor = Cursor
+cursors.SSCursor = SSCursor
+
+# The time the canned data is generated around, 2017-10-05 12:00:00 UTC
+START = datetime.datetime(2017, 10, 5, 12, 0, 0)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+SLOW_LOG_FILE_PADDING = 8192
+
+QUERY_RESPONSE_TIME_BOUNDS = ['      0.000001', '      0.000010', '      0.000100', '      0.001000', '      0.010000',
+                              '      0.100000', '      1.000000', '     10.000000', '    100.000000', '   1000.000000',
+                              '  10000.000000', ' 100000.000000', '1000000.000000', 'TOO LONG']
+
+class FakeServer(object):
+    """ Serves result sets of the given number of rows for each of the gather_* queries. The blocking
+        sessions form a tree, each session blocking up to 4 others, with a single root blocker. Slow
+        log entries are paginated like the real query, by end time after the cursor, so that the
+        collector's slow log cursor and page handling are exercised, and can also be written to a slow
+        log file. The user statistics and query response time counters go up each time they are read
+        after the first, apart from every third user's, so that the collector's counter deltas and rates
+        and changes-only output are exercised. Counts the queries executed """
+
+    def __init__(self, rows, users=None):
+        self.queries = 0
+        self.variables = [('hostname', 'bench.example.com'), ('server_id', '1'), ('slow_query_log', 'ON'),
+                          ('query_response_time_stats', 'ON'), ('userstat', 'ON'), ('version', '10.1.22-MariaDB')]
+        self.blocking = [self.make_blocking_row(i) for i in range(rows)]
+        self.slow_log = [self.make_slow_log_row(i) for i in range(rows)]
+        self.slow_log_end_times = [x[-1].strftime('%Y-%m-%d %H:%M:%S.%f') for x in self.slow_log]
+        self.rows = rows
+        # In seconds, advanced by the caller between runs so the collector doesn't see a restart
+        self.uptime = 86400
+        self.query_response_time_polls = 0
+        self.user_polls = 0
+        self.users = [('user%d' % i,) + tuple(i*7 + j if j not in (3, 4) else (i*7 + j)/4.0 for j in range(24))
+                      for i in range(rows if users is None else users)]
+        self.handlers = [(re.compile(pattern, re.I), handler) for pattern, handler in [
+            (r'^KILL QUERY', lambda query, params: []),
+            (r'^show global variables where', lambda query, params: self.variables),
+            (r'^show global status like \'Uptime\'', lambda query, params: [('Uptime', str(self.uptime))]),
+            (r'date_sub\(now\(\)', lambda query, params: [(START - datetime.timedelta(minutes=2),)]),
+            (r'lock_waits', self.get_blocking),
+            (r'from mysql\.slow_log', self.get_slow_log),
+            (r'from information_schema\.query_response_time', self.get_query_response_time),
+            (r'^show user_statistics', self.get_users)]]
+
+    def execute(self, query, params):
+        self.queries += 1
+        for pattern, handler in self.handlers:
+            if pattern.search(query):
+                return handler(query, params)
+        raise ProgrammingError(1146, 'FakeServer has no result set for query [' + query + ']')
+
+    def make_blocking_row(self, i):
+        waiting = 100 + i
+        blocking = 100 + (i - 1)//4 if i > 0 else 99
+        return (2000000 + waiting, waiting, 'UPDATE employees.salaries SET salary = salary + %d WHERE emp_no = %d' % (i, i % 500),
+                'writer', 'app%d.example.com:%d' % (i % 8, 40000 + i), START + datetime.timedelta(seconds=i % 60),
+                2000000 + blocking, blocking, 'UPDATE employees.salaries SET salary = salary * 1.01' if i < 4 else None,
+                'writer' if i else 'batch', 'app%d.example.com:%d' % (i % 8, 40000 + i), 60 - i % 60)
+
+    def make_slow_log_row(self, i):
+        # Shaped like the rows in bench_encoder.py, with SQL text that needs escaping and some NULLs
+        start_time = START + datetime.timedelta(microseconds=i*10)
+        query_time = datetime.timedelta(seconds=1, microseconds=i % 1000)
+        sql_text = ('SELECT e.first_name, e.last_name, "x y"\nFROM employees.employees e\n'
+                    'WHERE e.emp_no IN (%d, %d, %d) AND e.last_name = \'O\\\'Neil, J=%d\';' % (i, i + 1, i + 2, i))
+        return (start_time, 'reader[reader] @ localhost []', query_time, datetime.timedelta(microseconds=i % 1000),
+                i % 100, i*10, 'employees' if i % 10 else None, 0, 0, 1, sql_text, start_time + query_time)
+
+    def get_blocking(self, query, params):
+        return self.blocking[:params[0]] if params else self.blocking
+
+    def get_slow_log(self, query, params):
+        end_time, offset, page_size = params
+        first = bisect.bisect_left(self.slow_log_end_times, end_time) + offset
+        return self.slow_log[first:first + page_size]
+
+    def get_query_response_time(self, query, params):
+        self.query_response_time_polls += 1
+        counts = [self.rows*(i + 1) % 97*self.query_response_time_polls for i in range(len(QUERY_RESPONSE_TIME_BOUNDS))]
+        return [(x, count if x != 'TOO LONG' else 0, '%.6f' % (count*float(x.strip())/2) if x != 'TOO LONG' else 'TOO LONG')
+                for x, count in zip(QUERY_RESPONSE_TIME_BOUNDS, counts)]
+
+    def get_users(self, query, params):
+        polls = self.user_polls
+        self.user_polls += 1
+        if not polls:
+            return self.users
+        return [(x[0],) + tuple(y + polls*(i % 3) for y in x[1:]) for i, x in enumerate(self.users)]
+
+    def write_slow_log_file(self, path):
+        """ Writes the slow log entries to path as MySQL 5.7 would with log_output = 'FILE'. The start
+            times are written with SET timestamp as seconds since the epoch, taking them to be in UTC. The
+            first entry's query is padded with a comment to SLOW_LOG_FILE_PADDING bytes, like a big
+            extended INSERT, to exercise entries bigger than --slow-log-max-bytes """
+        db = None
+        with open(path, 'w') as f:
+            for i, row in enumerate(self.slow_log):
+                start_time, user_host, query_time, lock_time, rows_sent, rows_examined = row[:6]
+                f.write('# Time: ' + row[-1].strftime('%Y-%m-%dT%H:%M:%S.%fZ') + '\n')
+                f.write('# User@Host: %s  Id: %7d\n' % (user_host, i))
+                f.write('# Query_time: %.6f  Lock_time: %.6f Rows_sent: %d  Rows_examined: %d\n'
+                        % (query_time.total_seconds(), lock_time.total_seconds(), rows_sent, rows_examined))
+                if row[6] is not None and row[6] != db:
+                    db = row[6]
+                    f.write('use ' + db + ';\n')
+                f.write('SET timestamp=%d;\n' % ((start_time - EPOCH).days*86400 + (start_time - EPOCH).seconds))
+                f.write(('/* ' + 'x'*SLOW_LOG_FILE_PADDING + ' */ ' if i == 0 else '') + row[10] + '\n')
+
+def install(fake_server):
+    """ Makes import MySQLdb return this module, with connect returning connections to fake_server,
+        and stubs systemd.journal if it isn't installed """
+    global server
+    server = fake_server
+    sys.modules['MySQLdb'] = sys.modules[__name__]
+    sys.modules['MySQLdb.cursors'] = cursors
+    try:
+        __import__('systemd.journal')
+    except ImportError:
+        journal = types.ModuleType('systemd.journal')
+        journal.JournalHandler = logging.NullHandler
+        sys.modules['systemd'] = sys.modules.get('systemd', types.ModuleType('systemd'))
+        sys.modules['systemd'].journal = journal
+        sys.modules['systemd.journal'] = journal
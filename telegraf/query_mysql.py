@@ -1,10 +1,13 @@
 """
     A custom script to gather metrics from a MySQL instance. To be run by the Telegraf exec
-    plugin, and prints metrics in Influx line protocol format. To add new metrics create
+    plugin, and prints metrics in Influx line protocol format. It can also be run as a
+    long-lived process by the Telegraf execd plugin with --daemon, in which case the DB
+    connection and capability probes are kept between collections. To add new metrics create
     a new function gather_* and call it from gather_metrics. The gather_* function must:
-    1) Have at least the DB cursor as an argument to enable the DB to be called. It may also
-       be helpful to have host as the argument, so the host can be used as a tag value and
-       distinguish different DB instances once the metrics are in InfluxDB
+    1) Have the DB cursor and the Target as arguments. The cursor enables the DB to be called,
+       and the Target provides the host to be used as a tag value to distinguish different DB
+       instances once the metrics are in InfluxDB, and the capabilities (version and variables)
+       of the DB
     2) Have a query string
     3) Call execute_query to obtain the field values using the query string
     4) Have a measurement string to write the metrics to
@@ -14,18 +17,49 @@
 """
 
 import MySQLdb
+import MySQLdb.cursors
 import warnings
 import logging
 import argparse
+import signal
 import sys
 import os
 import time
 import datetime
+import json
+import math
+import calendar
+import errno
+import re
+import threading
+import hashlib
+import random
+import collections
+import struct
+import zlib
+import mmap
+import fcntl
+import select
 from systemd.journal import JournalHandler
+try:
+    import queue
+    import configparser
+    import urllib.request as urllib_request
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode
+except ImportError:
+    import Queue as queue
+    import ConfigParser as configparser
+    import urllib2 as urllib_request
+    from urllib2 import HTTPError, URLError
+    from urllib import urlencode
+
+# High resolution timer for the mysql_collector measurement, perf_counter is only in Python 3
+clock = getattr(time, 'perf_counter', time.time)
 
 def main():
 
-    global journal_log
+    global journal_log, options
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--host',default='localhost')
@@ -33,132 +67,992 @@ def main():
     parser.add_argument('--user',default='telegraf')
     parser.add_argument('--password',default='telegraf')
     parser.add_argument('--loglevel',default='ERROR')
-    args = parser.parse_args()
+    parser.add_argument('--daemon',action='store_true')
+    parser.add_argument('--signal',default='STDIN',choices=['STDIN','SIGUSR1','none'])
+    parser.add_argument('--interval',default=60,type=float)
+    parser.add_argument('--state-dir',default='/var/lib/telegraf/query_mysql')
+    parser.add_argument('--slow-log-file',default=None)
+    parser.add_argument('--slow-log-max-bytes',default=16*1024*1024,type=int)
+    parser.add_argument('--slow-log-mode',default='raw',choices=['raw','digest','both'])
+    parser.add_argument('--slow-digest-max-fingerprints',default=1000,type=int)
+    parser.add_argument('--pool-size',default=2,type=int)
+    parser.add_argument('--collector-timeout',default=10,type=float)
+    parser.add_argument('--timeout',default=[],action='append',type=collector_setting(float),metavar='COLLECTOR=SECONDS')
+    parser.add_argument('--max-rows',default=[],action='append',type=collector_setting(int),metavar='COLLECTOR=ROWS')
+    parser.add_argument('--blocking-mode',default='pairs',choices=['pairs','chains','both'])
+    parser.add_argument('--inventory',default=None)
+    parser.add_argument('--max-parallel-targets',default=4,type=int)
+    parser.add_argument('--capability-ttl',default=300,type=float)
+    parser.add_argument('--counter-fields',default='all',choices=['raw','derived','all'])
+    parser.add_argument('--userstat-changes-only',action='store_true')
+    parser.add_argument('--userstat-heartbeat',default=10,type=int)
+    parser.add_argument('--spool-dir',default=None)
+    parser.add_argument('--spool-segment-bytes',default=4*1024*1024,type=int)
+    parser.add_argument('--spool-max-bytes',default=256*1024*1024,type=int)
+    parser.add_argument('--flush-to',default='stdout',choices=['stdout','influxdb'])
+    parser.add_argument('--flush-batch-bytes',default=1024*1024,type=int)
+    parser.add_argument('--flush-timeout',default=10,type=float)
+    parser.add_argument('--flush-only',action='store_true')
+    parser.add_argument('--influxdb-url',default='http://localhost:8086')
+    parser.add_argument('--influxdb-database',default='telegraf')
+    parser.add_argument('--influxdb-retention-policy',default=None)
+    parser.add_argument('--influxdb-user',default=None)
+    parser.add_argument('--influxdb-password',default=None)
+    args = options = parser.parse_args()
+    options.timeouts = dict(args.timeout)
+    options.max_rows = dict(args.max_rows)
 
     warnings.simplefilter('error', MySQLdb.Warning)
     journal_log = logging.getLogger()
     journal_log.addHandler(JournalHandler())
     journal_log.setLevel(getattr(logging, args.loglevel.upper()))
 
-    gather_metrics(args.host, args.port, args.user, args.password)
+    if args.spool_dir:
+        setup_spool(args)
+    elif args.flush_only:
+        journal_log.error('--flush-only requires --spool-dir')
+        sys.exit(0)
+    if args.flush_only:
+        flush_spool()
+        return
 
-def gather_metrics(db_host, db_port, db_user, db_pass):
-    """ Connect to the DB and gather the metrics specified by the gather_* functions, 
-        then close the connection """
+    if args.inventory:
+        targets = load_inventory(args.inventory)
+    else:
+        state_file = None
+        if args.state_dir:
+            state_file = os.path.join(args.state_dir, args.host + '_' + str(args.port) + '.json')
+        targets = [Target(args.host, args.port, args.user, args.password, state_file, args.pool_size,
+                          slow_log_file=args.slow_log_file)]
     try:
-        db = MySQLdb.connect(host=db_host, port=db_port, user=db_user, passwd=db_pass)
-        cursor = db.cursor()
-    except MySQLdb.Warning as e:
-        journal_log.warning(e[0])
-    except MySQLdb.Error as e:
-        journal_log.error('Failed to connect to DB - ' + e[1] + '(' + str(e[0]) + ')')
+        if args.daemon:
+            run_daemon(targets, args.signal, args.interval)
+        else:
+            gather_all_metrics(targets)
+    finally:
+        for target in targets:
+            target.close()
+
+def setup_spool(args):
+    """ Sets up the spool that write_output writes to and flush_spool sends from """
+    global spool, spool_sink
+    try:
+        spool = Spool(args.spool_dir, args.spool_segment_bytes, args.spool_max_bytes)
+    except (IOError, OSError) as e:
+        journal_log.error('Failed to open spool ' + args.spool_dir + ' - ' + str(e))
         sys.exit(0)
+    if args.flush_to == 'influxdb':
+        spool_sink = InfluxDBWriter(args.influxdb_url, args.influxdb_database, args.influxdb_retention_policy,
+                                    args.influxdb_user, args.influxdb_password)
+    else:
+        spool_sink = StdoutWriter()
+
+def load_inventory(path):
+    """ Returns a list of Targets read from an inventory file in INI format. Each section is a target
+        named after the section, with the options host, port, user, password, socket (to connect with
+        a unix socket rather than host and port, e.g. for mysqld_multi), slow_log_file and tags. tags
+        is a comma separated list of key=value tags to add to the points from the target. Options not
+        given in a section are taken from the [DEFAULT] section, or from the command line. Points from
+        each target are tagged with instance=<section name>, unless instance is given in tags """
+    inventory = configparser.RawConfigParser()
+    if not inventory.read(path):
+        journal_log.error('Failed to read inventory file ' + path)
+        sys.exit(0)
+
+    targets = []
+    for name in inventory.sections():
+        def get(option, default):
+            if inventory.has_option(name, option):
+                return inventory.get(name, option)
+            return default
+
+        tags = [('instance', name)]
+        for tag in get('tags', '').split(','):
+            if tag.strip():
+                key, sep, value = tag.partition('=')
+                tags = [x for x in tags if x[0] != key.strip()] + [(key.strip(), value.strip())]
+
+        state_file = None
+        if options.state_dir:
+            state_file = os.path.join(options.state_dir, name + '.json')
+        targets.append(Target(get('host', options.host), int(get('port', options.port)),
+                              get('user', options.user), get('password', options.password),
+                              state_file, options.pool_size, unix_socket=get('socket', None),
+                              tags=tags, slow_log_file=get('slow_log_file', options.slow_log_file)))
+    return targets
+
+def collector_setting(value_type):
+    """ Returns an argparse type for a per-collector setting given on the command line as
+        COLLECTOR=VALUE, where COLLECTOR is the name of the gather_* function without 'gather_'.
+        The setting is parsed into a (COLLECTOR, VALUE) tuple with VALUE converted to value_type """
+    def parse(setting):
+        name, sep, value = setting.partition('=')
+        try:
+            return name, value_type(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid collector setting ' + repr(setting))
+    return parse
+
+def run_daemon(targets, signal_mode, interval):
+    """ Runs as a long-lived process for the Telegraf execd plugin. Metrics are gathered each
+        time Telegraf signals, either by writing a newline to stdin (signal = "STDIN") or by
+        sending SIGUSR1 (signal = "SIGUSR1"), or every interval seconds (signal = "none").
+        The connections to the DBs are kept open between collections and are re-established if
+        they are lost. Returns when stdin is closed or on SIGTERM """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if signal_mode == 'STDIN':
+        for line in iter(sys.stdin.readline, ''):
+            gather_all_metrics(targets)
+    elif signal_mode == 'SIGUSR1':
+        pending = []
+        signal.signal(signal.SIGUSR1, lambda signum, frame: pending.append(signum))
+        while True:
+            if not pending:
+                signal.pause()
+            del pending[:]
+            gather_all_metrics(targets)
+    else:
+        next_run = time.time()
+        while True:
+            gather_all_metrics(targets)
+            next_run += interval
+            time.sleep(max(0, next_run - time.time()))
+
+class Target(object):
+    """ A DB instance to gather metrics from. Holds a pool of at most pool_size connections to the
+        DB, so that the gather_* functions can run concurrently, and the result of the version and
+        capability probes, so that in daemon mode they are only made once per connection rather
+        than once per collection. Also holds the state that gather_* functions keep between
+        collections (e.g. the slow log cursor). This is kept in memory, and if a state file is
+        given it is also loaded from and saved to that file so that it survives between runs of
+        the exec plugin. The host tag is the hostname of the DB server, so that points from
+        different servers don't collide, and any other tags given (e.g. instance, to distinguish
+        several DB instances on the same server) are added after it """
+
+    def __init__(self, db_host, db_port, db_user, db_pass, state_file=None, pool_size=1,
+                 unix_socket=None, tags=None, slow_log_file=None):
+        self.db_host = db_host
+        self.db_port = db_port
+        self.connect_args = { 'user': db_user, 'passwd': db_pass }
+        if unix_socket:
+            self.connect_args['unix_socket'] = unix_socket
+        else:
+            self.connect_args['host'] = db_host
+            self.connect_args['port'] = db_port
+        self.host = os.uname()[1]
+        self.tag_keys = [x[0] for x in tags or []]
+        self.tag_values = [x[1] for x in tags or []]
+        self.slow_log_file = slow_log_file
+        self.caps = None
+        self.caps_stale = False
+        self.state_file = state_file
+        self.state = load_state(state_file) if state_file else {}
+        # Each slot in the pool holds either an idle connection or None, if the connection
+        # hasn't been opened yet or has been discarded
+        self.pool = queue.Queue()
+        for i in range(pool_size):
+            self.pool.put(None)
+
+    def connect(self):
+        """ Checks that the DB can be reached and that the capabilities of the DB are known. The
+            capabilities are cached in the target state for --capability-ttl seconds, so they are
+            kept in memory in daemon mode and in the state file between runs of the exec plugin.
+            They are fetched again when the cache expires, or if the server has restarted: in
+            daemon mode this is when a connection has been lost, otherwise when the time the
+            server started (worked out from its uptime) has changed. Returns False if the DB
+            can't be reached or the capabilities can't be fetched """
+        db = self.get_connection()
+        if db is None:
+            return False
+        cursor = db.cursor()
+
+        caps = self.state.get('capabilities')
+        if caps is not None and (self.caps_stale or time.time() - caps['fetched_at'] > options.capability_ttl):
+            caps = None
+        elif caps is not None and self.caps is None:
+            server_start = get_server_start(cursor)
+            if (server_start is None or caps['server_start'] is None or
+                abs(server_start - caps['server_start']) > SERVER_START_TOLERANCE):
+                journal_log.info('DB server has restarted, fetching its capabilities')
+                caps = None
+
+        if caps is None:
+            caps = get_capabilities(cursor)
+            self.caps_stale = False
+        self.put_connection(db)
+
+        self.caps = self.state['capabilities'] = caps
+        if caps is None:
+            del self.state['capabilities']
+            return False
+        if caps['hostname']:
+            self.host = caps['hostname']
+        return True
+
+    def get_connection(self, timeout=None):
+        """ Returns a connection from the pool, reconnecting if the pooled connection has been lost.
+            If all pool_size connections are in use, waits at most timeout seconds (or indefinitely
+            if timeout is None) for one to be returned. Returns None if no connection became free or
+            the DB can't be reached. The connection must be given back with put_connection or
+            discard_connection """
+        try:
+            db = self.pool.get(True, timeout)
+        except queue.Empty:
+            journal_log.error('Timed out waiting for a connection to the DB')
+            return None
+
+        if db is not None:
+            try:
+                db.ping()
+                return db
+            except MySQLdb.Error as e:
+                journal_log.warning('Lost connection to DB - ' + e.args[1] + '(' + str(e.args[0]) + '), reconnecting')
+                close_connection(db)
+                self.caps_stale = True
+
+        try:
+            return MySQLdb.connect(**self.connect_args)
+        except MySQLdb.Warning as e:
+            journal_log.warning(e.args[0])
+        except MySQLdb.Error as e:
+            journal_log.error('Failed to connect to DB - ' + e.args[1] + '(' + str(e.args[0]) + ')')
+        self.pool.put(None)
+        return None
+
+    def put_connection(self, db):
+        """ Returns a connection to the pool to be reused """
+        self.pool.put(db)
+
+    def discard_connection(self, db):
+        """ Closes a connection instead of returning it to the pool, e.g. if its query was killed """
+        close_connection(db)
+        self.pool.put(None)
+
+    def kill_query(self, thread_id):
+        """ Kills the query running on the connection with the given thread ID. This uses a new
+            connection, as all those in the pool may be in use """
+        try:
+            db = MySQLdb.connect(**self.connect_args)
+            try:
+                db.cursor().execute('KILL QUERY %s', (thread_id,))
+            finally:
+                db.close()
+        except MySQLdb.Warning as e:
+            journal_log.warning(e.args[0])
+        except MySQLdb.Error as e:
+            journal_log.error('Failed to kill query on thread ' + str(thread_id) + ' - ' + e.args[1] + '(' + str(e.args[0]) + ')')
+
+    def close(self):
+        """ Closes the idle connections in the pool """
+        closed = 0
+        while True:
+            try:
+                db = self.pool.get(False)
+            except queue.Empty:
+                break
+            if db is not None:
+                close_connection(db)
+            closed += 1
+        for i in range(closed):
+            self.pool.put(None)
+        self.caps = None
+
+    def save_state(self):
+        """ Saves the state to the state file, if there is one """
+        if self.state_file:
+            save_state(self.state_file, dict(self.state))
+
+def close_connection(db):
+    """ Closes a connection to the DB, ignoring errors as it may already have been lost """
+    try:
+        db.close()
+    except MySQLdb.Error:
+        pass
 
-    v = get_version(cursor)
-    host = os.uname()[1]
+def load_state(path):
+    """ Returns the state dictionary saved in the JSON file at path. Returns an empty
+        dictionary if the file doesn't exist or can't be read, so that collection starts
+        afresh rather than failing """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+    except ValueError as e:
+        journal_log.warning('Ignoring corrupt state file ' + path + ' - ' + str(e))
+        return {}
+
+def save_state(path, state):
+    """ Saves the state dictionary as JSON to the file at path. The file is written to
+        a temporary file then renamed, so a crash can't leave a partially written file """
+    try:
+        state_dir = os.path.dirname(path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        journal_log.error('Failed to save state to ' + path + ' - ' + str(e))
+
+def gather_all_metrics(targets):
+    """ Gathers the metrics from each of the targets, from at most --max-parallel-targets targets
+        at a time, then flushes the spool if there is one """
+    if len(targets) == 1:
+        gather_metrics(targets[0])
+        flush_spool()
+        return
+
+    pending = queue.Queue()
+    for target in targets:
+        pending.put(target)
+
+    def gather_pending():
+        while True:
+            try:
+                target = pending.get(False)
+            except queue.Empty:
+                return
+            try:
+                gather_metrics(target)
+            except Exception:
+                journal_log.exception('Failed to gather metrics from ' + target.host)
+
+    threads = [threading.Thread(target=gather_pending) for i in range(min(options.max_parallel_targets, len(targets)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    flush_spool()
 
-    gather_blocking_sessions(cursor, host, v)
-    gather_slow_queries(cursor, host)
-    gather_query_response_time(cursor, host)
-    gather_userstats(cursor, host, v)
+def gather_metrics(target):
+    """ Gather the metrics specified by the gather_* functions from the target DB. The gather_*
+        functions are run concurrently by run_collectors. The connections are left open so that
+        they can be reused by the next collection in daemon mode, the caller is responsible for
+        closing them """
+    start = clock()
+    collector_stats.counts = counts = {'rows': 0, 'errors': 0, 'truncated': 0}
+    connected = target.connect()
+    connect_time = clock() - start
+    if not connected:
+        counts['errors'] += 1
+        print_collector_metrics(target, [], clock() - start, connect_time, counts)
+        return
 
-    db.close()
+    threads = run_collectors(target, [gather_blocking_sessions,
+                                      gather_slow_log_file if target.slow_log_file else gather_slow_queries,
+                                      gather_query_response_time,
+                                      gather_userstats])
+    print_collector_metrics(target, threads, clock() - start, connect_time, counts)
+
+    with output_lock:
+        sys.stdout.flush()
+    target.save_state()
 
     journal_log.info('Successfully gathered MySQL metrics')
 
-def gather_blocking_sessions(cursor, host, versions):
-    query = ('SELECT r.trx_id waiting_trx_id, '
-             'r.trx_mysql_thread_id waiting_thread, '
-             'r.trx_query waiting_query, '
-             'pw.user waiting_user, '
-             'pw.host waiting_host, '
-             'r.trx_wait_started waiting_since, '
-             'b.trx_id blocking_trx_id, '
-             'b.trx_mysql_thread_id blocking_thread, '
-             'b.trx_query blocking_query, '
-             'pb.user blocking_user, '
-             'pb.host blocking_host '
-             'FROM information_schema.innodb_lock_waits w '
-             'INNER JOIN information_schema.innodb_trx b '
-             'ON b.trx_id = w.blocking_trx_id '
-             'INNER JOIN information_schema.innodb_trx r '
-             'ON r.trx_id = w.requesting_trx_id '
-             'INNER JOIN information_schema.processlist pb '
-             'ON pb.ID = b.trx_mysql_thread_id '
-             'INNER JOIN information_schema.processlist pw '
-             'ON pw.ID = r.trx_mysql_thread_id;')
+KILL_GRACE_TIME = 2
+
+def run_collectors(target, collectors):
+    """ Runs the gather_* functions concurrently, each in a CollectorThread with its own connection
+        from the target's pool, so the time taken is that of the slowest rather than the sum of them
+        all. Each function has a timeout, given by --timeout COLLECTOR=SECONDS or --collector-timeout,
+        counted from when the functions are started. If a function hasn't finished within its timeout
+        its query is killed and it is given KILL_GRACE_TIME seconds to finish, so one stuck query can't
+        hold up the others. The output of each function is buffered and written as a complete block
+        once it has finished (or been killed), apart from results streamed with execute_streaming, which
+        are written a chunk at a time. Returns the CollectorThreads """
+    start = time.time()
+    threads = []
+    for collector in collectors:
+        name = collector.__name__[len('gather_'):]
+        threads.append(CollectorThread(target, collector, options.timeouts.get(name, options.collector_timeout)))
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join(max(0, start + thread.timeout - time.time()))
+        if thread.is_alive():
+            journal_log.error('Collector ' + thread.name + ' timed out after ' + str(thread.timeout) + 's, killing its query')
+            thread.timed_out = True
+            thread.cancel()
+            thread.join(KILL_GRACE_TIME)
+            if thread.is_alive():
+                journal_log.error('Collector ' + thread.name + ' did not stop after its query was killed')
+        flush_output(thread.output, thread.counts)
+    return threads
+
+def print_collector_metrics(target, threads, duration, connect_time, counts):
+    """ Prints the mysql_collector measurement, with a point for each of the CollectorThreads and a point
+        with collector=all for the whole collection. Each point has the time taken in seconds, the time
+        spent getting a connection, the number of rows fetched, the number of bytes of line protocol
+        written, the number of errors (failed queries, or a collector failing or timing out), whether
+        it timed out and the number of results cut short by --max-rows. counts has the rows and errors
+        counted outside the CollectorThreads, e.g. when checking the DB capabilities """
+    measurement = 'mysql_collector'
+    tag_keys = ['host'] + target.tag_keys + ['collector']
+    field_keys = ['duration', 'connect_time', 'rows', 'bytes', 'errors', 'timed_out', 'truncated']
+    field_types = ['float', 'float', 'integer', 'integer', 'integer', 'integer', 'integer']
+
+    now = clock()
+    field_values = []
+    for thread in threads:
+        thread_duration = thread.duration if thread.duration is not None else now - thread.started
+        field_values.append([thread_duration, thread.connect_time, thread.counts['rows'], thread.counts['bytes'],
+                             thread.counts['errors'] + thread.timed_out, int(thread.timed_out), thread.counts['truncated']])
+    field_values.append([duration, connect_time, counts['rows'] + sum(x[2] for x in field_values), sum(x[3] for x in field_values),
+                         counts['errors'] + sum(x[4] for x in field_values), sum(x[5] for x in field_values),
+                         counts['truncated'] + sum(x[6] for x in field_values)])
+
+    tag_values = [target.host] + target.tag_values + [[x.name for x in threads] + ['all']]
+    print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, field_values, field_types)
+
+class CollectorThread(threading.Thread):
+    """ Runs a gather_* function with a connection from the target's pool, collecting everything the
+        function writes with write_output in self.output until it is written out by flush_output. The
+        time taken, the time spent getting a connection, the rows and errors counted by count_rows and
+        count_error and the bytes written are kept for print_collector_metrics """
+
+    def __init__(self, target, collector, timeout):
+        threading.Thread.__init__(self, name=collector.__name__[len('gather_'):])
+        self.daemon = True
+        self.target = target
+        self.collector = collector
+        self.timeout = timeout
+        self.output = []
+        self.db = None
+        self.cancelled = False
+        self.timed_out = False
+        self.lock = threading.Lock()
+        self.counts = {'rows': 0, 'errors': 0, 'truncated': 0, 'bytes': 0}
+        self.started = None
+        self.connect_time = None
+        self.duration = None
+
+    def run(self):
+        self.started = clock()
+        output_buffer.lines = self.output
+        collector_stats.counts = self.counts
+        try:
+            self.run_collector()
+        finally:
+            self.duration = clock() - self.started
+
+    def run_collector(self):
+        db = self.target.get_connection(self.timeout)
+        self.connect_time = clock() - self.started
+        if db is None:
+            count_error()
+            return
+        with self.lock:
+            self.db = db
+
+        try:
+            self.collector(db.cursor(), self.target)
+        except Exception:
+            journal_log.exception('Collector ' + self.name + ' failed')
+            count_error()
+            self.cancelled = True
+        finally:
+            with self.lock:
+                self.db = None
+                if self.cancelled:
+                    self.target.discard_connection(db)
+                else:
+                    self.target.put_connection(db)
+
+    def cancel(self):
+        """ Kills the query the function is running, if it is running one. Its connection is
+            discarded rather than returned to the pool when the function finishes """
+        with self.lock:
+            self.cancelled = True
+            if self.db is not None:
+                self.target.kill_query(self.db.thread_id())
+
+BLOCKING_QUERY = ('SELECT r.trx_id waiting_trx_id, '
+                  'r.trx_mysql_thread_id waiting_thread, '
+                  'r.trx_query waiting_query, '
+                  'pw.user waiting_user, '
+                  'pw.host waiting_host, '
+                  'r.trx_wait_started waiting_since, '
+                  'b.trx_id blocking_trx_id, '
+                  'b.trx_mysql_thread_id blocking_thread, '
+                  'b.trx_query blocking_query, '
+                  'pb.user blocking_user, '
+                  'pb.host blocking_host, '
+                  'timestampdiff(second, r.trx_wait_started, now()) wait_age '
+                  'FROM {lock_waits} w '
+                  'INNER JOIN information_schema.innodb_trx b '
+                  'ON b.trx_id = w.{blocking_trx_id} '
+                  'INNER JOIN information_schema.innodb_trx r '
+                  'ON r.trx_id = w.{requesting_trx_id} '
+                  'INNER JOIN information_schema.processlist pb '
+                  'ON pb.ID = b.trx_mysql_thread_id '
+                  'INNER JOIN information_schema.processlist pw '
+                  'ON pw.ID = r.trx_mysql_thread_id')
+
+def gather_blocking_sessions(cursor, target):
+    """ Gathers the transactions waiting for a lock and the transactions blocking them. Depending on
+        --blocking-mode, writes a mysql_blocking point for every pair of waiting and blocking transactions
+        (pairs, the default), and/or a mysql_blocking_chain point for every root blocker (a session that is
+        blocking others but isn't waiting itself) or cycle of sessions waiting for each other, and a
+        mysql_blocking_summary point (chains), see find_blocking_chains. MySQL 8 has the lock waits in
+        performance_schema.data_lock_waits rather than information_schema.innodb_lock_waits """
     measurement = 'mysql_blocking'
-    tag_keys = ['host']
-    tag_values = [host]
+    tag_keys = ['host'] + target.tag_keys
+    tag_values = [target.host] + target.tag_values
     field_keys = ['waiting_trx_id', 'waiting_thread', 'waiting_query', 'waiting_user', 'waiting_host', 'waiting_since',
                   'blocking_trx_id', 'blocking_thread', 'blocking_query', 'blocking_user', 'blocking_host']
     field_types = ['integer', 'integer', 'string', 'string', 'string', 'string',
                    'integer', 'integer', 'string', 'string', 'string']
 
-    if (versions['type'] == 'MariaDB' or
-       (versions['major_version'] == 5 and versions['minor_version'] >= 5)):
+    versions = target.caps
+    if versions['type'] == 'MySQL' and versions['major_version'] >= 8:
+        query = BLOCKING_QUERY.format(lock_waits='performance_schema.data_lock_waits',
+                                      blocking_trx_id='BLOCKING_ENGINE_TRANSACTION_ID',
+                                      requesting_trx_id='REQUESTING_ENGINE_TRANSACTION_ID')
+    elif (versions['type'] == 'MariaDB' or
+         (versions['major_version'] == 5 and versions['minor_version'] >= 5)):
+        query = BLOCKING_QUERY.format(lock_waits='information_schema.innodb_lock_waits',
+                                      blocking_trx_id='blocking_trx_id',
+                                      requesting_trx_id='requesting_trx_id')
+    else:
+        query = None
 
-        field_values = execute_query(cursor, query)
-        print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, field_values, field_types, increment_ts=True)
+    if query is not None:
+        # Stream the rows, as there can be a row for every pair of waiting and blocking transactions
+        max_rows = options.max_rows.get('blocking_sessions')
+        params = None
+        if max_rows is not None:
+            query += ' limit %s'
+            params = (max_rows + 1,)
+        rows = 0
+        waits = {}
+        for data in execute_streaming(cursor, query, params, max_rows):
+            if options.blocking_mode != 'chains':
+                print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, [x[:-1] for x in data], field_types,
+                                           increment_ts=True, first_index=rows)
+            rows += len(data)
+            if options.blocking_mode != 'pairs':
+                for x in data:
+                    waits.setdefault(x[1], {})[x[7]] = x
+
+        if options.blocking_mode != 'pairs':
+            print_blocking_chains(target, waits)
 
     journal_log.info('Successfully queried for blocking sessions')
 
-def gather_slow_queries(cursor, host):
-    """ This queries for slow queries that have finished within the last 2 minutes (although the Telegraf
-        exec plugin runs every 1 minute, 2 minutes is chosen to avoid potentially missing any queries due
-        to timing). To avoid queries being counted twice, the 'start_time' field is used as the timestamp
-        in InfluxDB, so that even if any queries are submitted twice, they will be overwritten as they have
-        the same timestamp. """
+def print_blocking_chains(target, waits):
+    """ Prints the mysql_blocking_chain points for the chains found by find_blocking_chains, and a
+        mysql_blocking_summary point with the number of root blockers, blocked sessions and cycles, the
+        longest chain and the longest wait, which is written even if nothing is blocked """
+    chains = find_blocking_chains(waits)
+    tag_keys = ['host'] + target.tag_keys
+    tag_values = [target.host] + target.tag_values
+
+    field_keys = ['root_thread', 'root_user', 'root_host', 'root_query', 'depth', 'blocked_sessions', 'oldest_wait', 'cycle']
+    field_types = ['integer', 'string', 'string', 'string', 'integer', 'integer', 'integer', 'boolean']
+    print_influx_line_protocol('mysql_blocking_chain', tag_keys, tag_values, field_keys, chains, field_types, increment_ts=True)
+
+    field_keys = ['root_blockers', 'blocked_sessions', 'cycles', 'max_depth', 'oldest_wait']
+    field_types = ['integer', 'integer', 'integer', 'integer', 'integer']
+    field_values = [[sum(1 for x in chains if not x[7]),
+                     len(waits),
+                     sum(1 for x in chains if x[7]),
+                     max([x[4] for x in chains] or [0]),
+                     max([x[6] for x in chains if x[6] is not None] or [0])]]
+    print_influx_line_protocol('mysql_blocking_summary', tag_keys, tag_values, field_keys, field_values, field_types)
+
+def find_blocking_chains(waits):
+    """ Finds the chains of blocked sessions in the wait-for graph given by waits, a dictionary from each
+        waiting thread to a dictionary from each thread blocking it to its row of gather_blocking_sessions.
+        Returns a list with an entry for each root blocker (a thread that blocks others but isn't waiting
+        itself), of its thread ID, user, host and query, the depth of the longest chain of sessions waiting
+        on it, the number of sessions it is blocking directly or indirectly, the longest time in seconds any
+        of them has been waiting, and False. Sessions that can't reach a root blocker are waiting in a cycle
+        (or on one), and there is an entry for each group of them with the lowest thread ID of the group
+        as the root, its depth as the number of sessions in it and True """
+    blocked_by = {}
+    for waiting, blockers in waits.items():
+        for blocking in blockers:
+            blocked_by.setdefault(blocking, []).append(waiting)
+    wait_ages = dict((waiting, max([x[-1] for x in blockers.values() if x[-1] is not None] or [None]))
+                     for waiting, blockers in waits.items())
+
+    chains = []
+    reached = set()
+    for root in sorted(x for x in blocked_by if x not in waits):
+        row = waits[blocked_by[root][0]][root]
+        depths = {root: 0}
+        pending = [root]
+        for thread in pending:
+            for waiting in blocked_by.get(thread, []):
+                if waiting not in depths:
+                    depths[waiting] = depths[thread] + 1
+                    pending.append(waiting)
+        del depths[root]
+        reached.update(depths)
+        ages = [wait_ages[x] for x in depths if wait_ages[x] is not None]
+        chains.append([root, row[9], row[10], row[8], max(depths.values()), len(depths), max(ages) if ages else None, False])
+
+    # Group the remaining sessions by which of them are waiting on each other
+    remaining = set(waits) - reached
+    while remaining:
+        group = set([remaining.pop()])
+        pending = list(group)
+        for thread in pending:
+            for other in list(waits.get(thread, {})) + blocked_by.get(thread, []):
+                if other in remaining:
+                    remaining.discard(other)
+                    group.add(other)
+                    pending.append(other)
+        root = min(group)
+        row = next(iter(waits[root].values()))
+        ages = [wait_ages[x] for x in group if x in wait_ages and wait_ages[x] is not None]
+        chains.append([root, row[3], row[4], row[2], len(group), len(group), max(ages) if ages else None, True])
+
+    return chains
+
+SLOW_QUERIES_MAX_ROWS = 10000
+SLOW_LOG_FIELD_KEYS = ['start_time', 'user_host', 'query_time', 'lock_time', 'rows_sent', 'rows_examined', 'db',
+                       'last_insert_id', 'insert_id', 'server_id', 'sql_text']
+SLOW_LOG_FIELD_TYPES = ['string', 'string', 'string', 'string', 'integer', 'integer', 'string',
+                        'integer', 'integer', 'integer', 'string']
+
+def gather_slow_queries(cursor, target):
+    """ This queries for slow queries that have finished since the last collection. Queries are written to
+        the slow log when they finish, so the end time (start_time + query_time) of the last query gathered,
+        and the number of queries gathered with that end time, are kept in the target state as a cursor.
+        Only the rows past the cursor are fetched, with a single query streamed from the server, so each
+        query is only written once. The rows are ordered by end time then by the other columns, so that rows
+        with the same end time (common, as the times may only have second resolution) come back in the same
+        order every time and skipping the ones already seen is safe. Rows that are the same in all those
+        columns are interchangeable. At most --max-rows slow_queries=ROWS rows are fetched per collection
+        (by default SLOW_QUERIES_MAX_ROWS), any remaining rows are gathered by the next collection. If
+        there is no cursor (e.g. the first run) queries that have finished within the last 2 minutes are
+        gathered. The 'start_time' field is used as the timestamp in InfluxDB. The queries are written by
+        write_slow_queries """
     query = ('select start_time, user_host, query_time, lock_time, rows_sent, rows_examined, db, '
-             'last_insert_id, insert_id, server_id, sql_text from mysql.slow_log '
-             'where addtime(start_time,query_time) > date_sub(now(), interval 2 minute);')
+             'last_insert_id, insert_id, server_id, sql_text, addtime(start_time,query_time) end_time '
+             'from mysql.slow_log where addtime(start_time,query_time) >= %s '
+             'order by end_time, start_time, server_id, user_host, db, sql_text limit %s, %s')
+    start_query = 'select date_sub(now(), interval 2 minute)'
 
-    measurement = 'mysql_slow'
-    tag_keys = ['host']
-    tag_values = [host]
-    field_keys = ['start_time', 'user_host', 'query_time', 'lock_time', 'rows_sent', 'rows_examined', 'db',
-                  'last_insert_id', 'insert_id', 'server_id', 'sql_text']
-    field_types = ['string', 'string', 'string', 'string', 'integer', 'integer', 'string',
-                  'integer', 'integer', 'integer', 'string']
+    if target.caps['slow_query_log']:
+        digest = SlowQueryDigest(target) if options.slow_log_mode != 'raw' else None
+        if 'slow_log_cursor' in target.state:
+            end_time, seen = target.state['slow_log_cursor']
+        else:
+            data = execute_query(cursor, start_query)
+            if not data:
+                return
+            end_time, seen = data[0][0].strftime('%Y-%m-%d %H:%M:%S.%f'), 0
 
-    if variable_is_on(cursor,'slow_query_log'):
-        field_values = execute_query(cursor, query)
-        print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, field_values, field_types, ts_field='start_time')
+        max_rows = options.max_rows.get('slow_queries', SLOW_QUERIES_MAX_ROWS)
+        for data in execute_streaming(cursor, query, (end_time, seen, max_rows + 1), max_rows):
+            write_slow_queries(target, digest, [x[:-1] for x in data])
+            for x in data:
+                row_end_time = x[-1].strftime('%Y-%m-%d %H:%M:%S.%f')
+                if row_end_time == end_time:
+                    seen += 1
+                else:
+                    end_time, seen = row_end_time, 1
+            target.state['slow_log_cursor'] = [end_time, seen]
+        if digest is not None:
+            digest.flush()
 
     journal_log.info('Successfully queried for slow queries')
 
-def gather_query_response_time(cursor, host):
+def gather_slow_log_file(cursor, target):
+    """ Gathers slow queries from the slow log file given by --slow-log-file, for when the server logs to a
+        file (log_output = 'FILE') rather than to mysql.slow_log. The file is followed like tail -f: the inode
+        and the offset reached are kept in the target state, and only complete entries added since the last
+        collection are read, at most --slow-log-max-bytes per collection. If the inode changes (the log has
+        been rotated) or the file is smaller than the offset (it has been truncated), reading starts again
+        from the beginning of the file. If there is no offset (e.g. the first run), reading starts from the
+        end of the file. Each multi-line entry is parsed into the same measurement and fields as
+        gather_slow_queries. The path is given by --slow-log-file or slow_log_file in the inventory """
+    path = target.slow_log_file
+    digest = SlowQueryDigest(target) if options.slow_log_mode != 'raw' else None
+
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        journal_log.error('Failed to read slow log file ' + path + ' - ' + str(e))
+        return
+
+    if 'slow_log_file' not in target.state:
+        inode, offset = stat.st_ino, stat.st_size
+    else:
+        inode, offset = target.state['slow_log_file']
+        if inode != stat.st_ino:
+            journal_log.info('Slow log file ' + path + ' has been rotated, reading from the start')
+            inode, offset = stat.st_ino, 0
+        elif stat.st_size < offset:
+            journal_log.info('Slow log file ' + path + ' has been truncated, reading from the start')
+            offset = 0
+
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for entries, offset in read_slow_log_entries(f, offset, options.slow_log_max_bytes):
+                count_rows(len(entries))
+                field_values = []
+                for entry in entries:
+                    values = parse_slow_log_entry(entry, target.caps['server_id'])
+                    if values is None:
+                        continue
+                    # The DB is only logged when it changes. Until it is known it is left out, like a NULL
+                    # db in mysql.slow_log
+                    if values[6] is None:
+                        values[6] = target.state.get('slow_log_db')
+                    target.state['slow_log_db'] = values[6]
+                    field_values.append(values)
+                write_slow_queries(target, digest, field_values, separate_start_times(target.state, field_values))
+                target.state['slow_log_file'] = [inode, offset]
+    except IOError as e:
+        journal_log.error('Failed to read slow log file ' + path + ' - ' + str(e))
+        count_error()
+        return
+    finally:
+        if digest is not None:
+            digest.flush()
+
+    target.state['slow_log_file'] = [inode, offset]
+
+    journal_log.info('Successfully read slow queries from ' + path)
+
+def write_slow_queries(target, digest, field_values, ts_offsets=None):
+    """ Writes slow queries (lists of values for the fields in SLOW_LOG_FIELD_KEYS) to the mysql_slow
+        measurement, one point per query, and/or adds them to the digest, depending on --slow-log-mode.
+        ts_offsets is passed on to print_influx_line_protocol """
+    if options.slow_log_mode != 'digest':
+        print_influx_line_protocol('mysql_slow', ['host'] + target.tag_keys, [target.host] + target.tag_values,
+                                   SLOW_LOG_FIELD_KEYS, field_values, SLOW_LOG_FIELD_TYPES, ts_field='start_time',
+                                   ts_offsets=ts_offsets)
+    if digest is not None:
+        for values in field_values:
+            digest.add(values)
+
+SLOW_DIGEST_RESERVOIR_SIZE = 100
+SLOW_DIGEST_FIELD_KEYS = ['count', 'query_time_sum', 'query_time_max', 'query_time_p50', 'query_time_p95', 'query_time_p99',
+                          'lock_time_sum', 'lock_time_max', 'lock_time_p50', 'lock_time_p95', 'lock_time_p99',
+                          'rows_examined_sum', 'rows_examined_max', 'rows_examined_p50', 'rows_examined_p95', 'rows_examined_p99',
+                          'fingerprint', 'sample']
+SLOW_DIGEST_FIELD_TYPES = ['integer'] + ['float']*10 + ['integer', 'integer', 'float', 'float', 'float'] + ['string', 'string']
+
+class SlowQueryDigest(object):
+    """ Aggregates the slow queries gathered in a collection by their fingerprint (see fingerprint_query)
+        and DB, and writes a point per fingerprint to the mysql_slow_digest measurement, tagged with the DB
+        and a hash of the fingerprint. Each point has the number of queries, the sum, maximum and approximate
+        50th, 95th and 99th percentiles of their query time and lock time in seconds and of the rows they
+        examined, the fingerprint and the slowest query as a sample. The percentiles are worked out from a
+        random sample of at most SLOW_DIGEST_RESERVOIR_SIZE of the queries. At most
+        --slow-digest-max-fingerprints fingerprints are kept, if there are more the least recently seen one is
+        written out early so memory use is bounded during a storm of distinct queries. If that fingerprint is
+        seen again in the same collection it gets another point, so like increment_ts, the points written early
+        have 1ms added to their timestamp for each written before them so they don't overwrite each other or
+        the points written at the end of the collection in InfluxDB """
+
+    def __init__(self, target):
+        self.target = target
+        self.max_fingerprints = options.slow_digest_max_fingerprints
+        self.entries = collections.OrderedDict()
+        self.random = random.Random()
+        self.evicted = 0
+
+    def add(self, values):
+        query_time = values[2].total_seconds()
+        lock_time = values[3].total_seconds()
+        rows_examined = values[5]
+        fingerprint = fingerprint_query(to_str(values[10]))
+        key = (values[6], fingerprint)
+
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            entry = { 'count': 0, 'sums': [0.0, 0.0, 0], 'maxes': [0.0, 0.0, 0], 'reservoir': [], 'sample': values[10] }
+            if len(self.entries) >= self.max_fingerprints:
+                self.evicted += 1
+                self.write([self.entries.popitem(last=False)], self.evicted)
+        self.entries[key] = entry
+
+        sample = (query_time, lock_time, rows_examined)
+        entry['count'] += 1
+        if query_time > entry['maxes'][0]:
+            entry['sample'] = values[10]
+        entry['sums'] = [x + y for x, y in zip(entry['sums'], sample)]
+        entry['maxes'] = [max(x, y) for x, y in zip(entry['maxes'], sample)]
+        if len(entry['reservoir']) < SLOW_DIGEST_RESERVOIR_SIZE:
+            entry['reservoir'].append(sample)
+        else:
+            i = self.random.randrange(entry['count'])
+            if i < SLOW_DIGEST_RESERVOIR_SIZE:
+                entry['reservoir'][i] = sample
+
+    def flush(self):
+        """ Writes all the fingerprints """
+        self.write(list(self.entries.items()))
+        self.entries.clear()
+
+    def write(self, items, offset=0):
+        """ Writes a point for each of the items, with offset ms added to the timestamp """
+        tag_keys = ['host'] + self.target.tag_keys + ['db', 'digest']
+        dbs = []
+        digests = []
+        field_values = []
+        for (db, fingerprint), entry in items:
+            dbs.append(db)
+            digests.append(hashlib.md5(fingerprint.encode('utf-8') if not isinstance(fingerprint, bytes) else fingerprint).hexdigest()[:16])
+            values = [entry['count']]
+            for i in range(3):
+                reservoir = sorted(x[i] for x in entry['reservoir'])
+                values += [entry['sums'][i], entry['maxes'][i],
+                           percentile(reservoir, 50), percentile(reservoir, 95), percentile(reservoir, 99)]
+            field_values.append(values + [fingerprint, entry['sample']])
+        tag_values = [self.target.host] + self.target.tag_values + [dbs, digests]
+        print_influx_line_protocol('mysql_slow_digest', tag_keys, tag_values, SLOW_DIGEST_FIELD_KEYS, field_values, SLOW_DIGEST_FIELD_TYPES,
+                                   increment_ts=offset > 0, first_index=offset)
+
+def percentile(values, p):
+    """ Returns the p'th percentile of a sorted list of values by the nearest rank method, None if there are no values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(math.ceil(p/100.0*len(values))) - 1))]
+
+QUERY_STRING_OR_COMMENT = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"|/\*.*?\*/|(?:-- |#)[^\n]*", re.DOTALL)
+QUERY_NUMBER = re.compile(r'(?<![\w.$])(?:0x[0-9a-f]+|[+-]?\d+(?:\.\d*)?(?:e[+-]?\d+)?|[+-]?\.\d+(?:e[+-]?\d+)?)(?![\w$])', re.IGNORECASE)
+QUERY_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+QUERY_VALUES = re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+')
+QUERY_SPACE = re.compile(r'\s+')
+
+def fingerprint_query(sql_text):
+    """ Returns a normalised form of the query so that queries that only differ in their literal values
+        have the same fingerprint, e.g. "SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'" becomes
+        "select * from t where id in (?+) and name = ?". Comments are removed, string and number literals
+        are replaced by ?, lists of literals (including multi-row VALUES) are collapsed, whitespace is
+        collapsed and the query is lower cased """
+    query = QUERY_STRING_OR_COMMENT.sub(lambda x: '?' if x.group()[0] in '\'"' else ' ', sql_text)
+    query = QUERY_NUMBER.sub('?', query)
+    query = QUERY_LIST.sub('(?+)', query)
+    query = QUERY_VALUES.sub('(?+)', query)
+    query = QUERY_SPACE.sub(' ', query).strip().rstrip(';').strip()
+    return query.lower()
+
+def gather_query_response_time(cursor, target):
     """ Gathers query response time. Requires the query response time plugin
-        which is only available in MariaDB and query_response_time_stats='ON' """
-    count_query = 'SELECT count from information_schema.query_response_time order by time asc'
-    sum_query = 'SELECT SUM(total), SUM(count) from information_schema.query_response_time'
+        which is only available in MariaDB and query_response_time_stats='ON'. The bucket boundaries
+        are read from the table, as they depend on query_response_time_range_base, and each bucket's
+        field is named after its upper bound e.g. 100ms_count. As well as the counters, estimates of the
+        50th, 95th and 99th percentile response time in seconds since the last run are written as p50,
+        p95 and p99, and a mysql_query_response_bucket point is written for each bucket (tagged with its
+        upper bound as le) with the number of queries no longer than that bound """
+    query = 'SELECT time, count, total from information_schema.query_response_time'
     measurement = 'mysql_query_response'
-    tag_keys = ['host']
-    tag_values = [host]
-    field_keys = ['sum_total', 'sum_count', '1us_count', '10us_count', '100us_count','1ms_count', '10ms_count', '100ms_count',
-                  '1s_count', '10s_count', '100s_count', '1000s_count', '10000s_count', '100000s_count', '1000000s_count', 'too_long_count']
-    field_types = ['float', 'integer', 'integer', 'integer', 'integer', 'integer', 'integer', 'integer', 'integer',
-                   'integer', 'integer', 'integer', 'integer', 'integer', 'integer', 'integer']
-
-    if variable_is_on(cursor,'query_response_time_stats'):
-        try:
-            data = execute_query(cursor, sum_query)
-            sum_query_response = [float(data[0][0]), int(data[0][1])]
+    tag_keys = ['host'] + target.tag_keys
+    tag_values = [target.host] + target.tag_values
 
-            data = execute_query(cursor, count_query)
-            field_values = [[x for x in sum_query_response] + [int(x[0]) for x in data]]
-        except IndexError:
+    if target.caps['query_response_time_stats']:
+        data = execute_query(cursor, query)
+        if not data:
             return
+        # The time column is a padded string, so sort by the parsed bound rather than in the query
+        data = sorted(data, key=lambda x: parse_response_time_bound(x[0]))
+        bounds = [parse_response_time_bound(x[0]) for x in data]
+        counts = [int(x[1]) for x in data]
+        bucket_keys = [response_time_bucket_name(x) + '_count' for x in bounds]
+
+        field_keys = ['sum_total', 'sum_count'] + bucket_keys
+        field_values = [[sum(float(x[2]) for x, bound in zip(data, bounds) if not math.isinf(bound)), sum(counts)] + counts]
+        field_types = ['float', 'integer'] + ['integer']*len(bucket_keys)
 
+        # The buckets are part of the series name, so that the counters aren't compared with ones from
+        # different buckets after query_response_time_range_base is changed
+        field_keys, field_values, field_types = derive_counter_fields(target, measurement, [','.join(bucket_keys)], field_keys,
+                                                                      field_values, field_types)
+        deltas = None
+        if options.counter_fields != 'raw':
+            deltas = [field_values[0][field_keys.index(x + '_delta')] for x in bucket_keys]
+            if None in deltas:
+                deltas = None
+            else:
+                field_keys = field_keys + ['p50', 'p95', 'p99']
+                field_values = [field_values[0] + [estimate_percentile(bounds, deltas, x) for x in [50, 95, 99]]]
+                field_types = field_types + ['float']*3
         print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, field_values, field_types)
 
+        bucket_field_keys = []
+        bucket_field_values = [[] for x in bounds]
+        if options.counter_fields != 'derived':
+            bucket_field_keys.append('count')
+            for values, count in zip(bucket_field_values, cumulative_sum(counts)):
+                values.append(count)
+        if deltas is not None:
+            bucket_field_keys.append('count_delta')
+            for values, count in zip(bucket_field_values, cumulative_sum(deltas)):
+                values.append(count)
+        if bucket_field_keys:
+            le = ['+Inf' if math.isinf(bound) else x[0].strip() for x, bound in zip(data, bounds)]
+            print_influx_line_protocol('mysql_query_response_bucket', tag_keys + ['le'], tag_values + [le], bucket_field_keys,
+                                       bucket_field_values, ['integer']*len(bucket_field_keys))
+
         journal_log.info('Successfully queried for query response time')
 
-def gather_userstats(cursor, host, versions):
+def parse_response_time_bound(time_string):
+    """ Returns the upper bound in seconds of a query_response_time bucket from its time
+        column, which is infinite for the last bucket ('TOO LONG') """
+    try:
+        return float(time_string)
+    except ValueError:
+        return float('inf')
+
+def response_time_bucket_name(bound):
+    """ Returns the name used in the field keys for the bucket with the given upper bound in
+        seconds e.g. 100us, 10ms or 1000s, or too_long for the last bucket """
+    if math.isinf(bound):
+        return 'too_long'
+    microseconds = int(round(bound*10**6))
+    if microseconds % 10**6 == 0:
+        return str(microseconds//10**6) + 's'
+    if microseconds % 10**3 == 0:
+        return str(microseconds//10**3) + 'ms'
+    return str(microseconds) + 'us'
+
+def estimate_percentile(bounds, counts, p):
+    """ Estimates the pth percentile of a histogram with the given bucket upper bounds and counts,
+        assuming the values in each bucket are spread evenly between its bounds. A percentile in the
+        last, unbounded, bucket is given as its lower bound. Returns None if the histogram is empty """
+    total = sum(counts)
+    if total <= 0:
+        return None
+    rank = total*p/100.0
+    seen = 0
+    lower = 0.0
+    for bound, count in zip(bounds, counts):
+        if count > 0 and seen + count >= rank:
+            if math.isinf(bound):
+                return lower
+            return lower + (bound - lower)*(rank - seen)/count
+        seen += count
+        if not math.isinf(bound):
+            lower = bound
+    return lower
+
+def cumulative_sum(values):
+    """ Returns a list of the running totals of values """
+    totals = []
+    total = 0
+    for x in values:
+        total += x
+        totals.append(total)
+    return totals
+
+def gather_userstats(cursor, target):
     """ Gathers user statistics, is only available in MariaDB and requires userstat ='ON' """
     query = 'show user_statistics'
     measurement = 'mysql_userstat'
-    tag_keys = ['host','user']
+    tag_keys = ['host'] + target.tag_keys + ['user']
     field_keys = ['total_connections', 'concurrent_connections', 'connected_time', 'busy_time', 'cpu_time', 'bytes_received', 'bytes_sent',
                   'binlog_bytes_written', 'rows_read', 'rows_sent', 'rows_deleted', 'rows_inserted', 'rows_updated', 'select_commands',
                   'update_commands', 'other_commands', 'commit_transactions', 'rollback_transactions', 'denied_connections', 'lost_connections',
@@ -168,30 +1062,128 @@ def gather_userstats(cursor, host, versions):
                    'integer', 'integer', 'integer', 'integer', 'integer', 'integer',
                    'integer', 'integer', 'integer', 'integer']
 
-    if variable_is_on(cursor,'userstat'):
+    if target.caps['userstat']:
+        versions = target.caps
         # total_ssl_connections and max_statement_time_exceeded not available in MariaDB < 10.1.1
         if (versions['major_version'] < 10 or
            (versions['major_version'] == 10 and versions['minor_version'] == 1 and versions['patch_number'] < 1)):
             field_keys = field_keys[:-2]
             field_types = field_types[:-2]
         data = execute_query(cursor, query)
+        users = [x[0] for x in data]
         field_values = [x[1:] for x in data]
-        tag_values = [host, [x[0] for x in data]]
+        if options.userstat_changes_only:
+            changed = find_changed_series(target, measurement, users, field_values, field_types, options.userstat_heartbeat)
+        field_keys, field_values, field_types = derive_counter_fields(target, measurement, users, field_keys, field_values, field_types,
+                                                                      gauges=['concurrent_connections'])
+        if options.userstat_changes_only:
+            field_values = [x for x, y in zip(field_values, changed) if y]
+            users = [x for x, y in zip(users, changed) if y]
+        tag_values = [target.host] + target.tag_values + [users]
         print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, field_values, field_types)
+
+        if options.userstat_changes_only:
+            suppressed = len(data) - len(users)
+            print_influx_line_protocol('mysql_userstat_summary', tag_keys[:-1], tag_values[:-1],
+                                       ['users_total', 'users_emitted', 'users_suppressed', 'suppression_ratio'],
+                                       [[len(data), len(users), suppressed, float(suppressed)/len(data) if data else 0.0]],
+                                       ['integer', 'integer', 'integer', 'float'])
         journal_log.info('Successfully queried for user statistics')
 
-def get_version(cursor):
+def find_changed_series(target, name, series, field_values, field_types, heartbeat):
+    """ Returns a list of booleans saying whether the point for each series (e.g. user) should be written,
+        which is when any of its fields has changed since its last written point, or when its point has
+        not been written for the last heartbeat - 1 runs so that the series doesn't appear to have ended.
+        The last written values are kept in the target state under name """
+    all_written = target.state.setdefault('last_written', {})
+    previous = all_written.get(name, {})
+    written = {}
+    changed = []
+    for key, values in zip(series, field_values):
+        sample = [None if x is None else int(x) if field_type == 'integer' else float(x)
+                  for x, field_type in zip(values, field_types)]
+        last = previous.get(key)
+        if last is None or last[0] != sample or last[1] + 1 >= heartbeat:
+            written[key] = [sample, 0]
+            changed.append(True)
+        else:
+            written[key] = [last[0], last[1] + 1]
+            changed.append(False)
+    all_written[name] = written
+    return changed
+
+def derive_counter_fields(target, name, series, field_keys, field_values, field_types, gauges=()):
+    """ Adds the change in each counter field since the previous sample of the same series (e.g. user),
+        and its rate per second, as <field>_delta and <field>_rate fields so that dashboards don't have to
+        work them out from the raw counters. The previous samples are kept in the target state under name.
+        A counter going down (e.g. after FLUSH USER_STATISTICS) or the server restarting is treated as a
+        reset, and the delta is the counter's current value. The first sample of a series has no derived
+        fields. With --counter-fields derived only the derived fields and the gauges are written, with raw
+        only the raw fields are written and nothing is kept. Returns the field keys, values and types """
+    if options.counter_fields == 'raw':
+        return field_keys, field_values, field_types
+
+    now = time.time()
+    server_start = target.caps['server_start']
+    counters = [i for i, key in enumerate(field_keys) if key not in gauges]
+    kept = [i for i, key in enumerate(field_keys) if options.counter_fields == 'all' or key in gauges]
+    casts = [int if field_types[i] == 'integer' else float for i in counters]
+
+    all_counters = target.state.setdefault('counters', {})
+    previous = all_counters.get(name)
+    if previous is not None:
+        elapsed = now - previous['time']
+        restarted = (server_start is None or previous['server_start'] is None or
+                     abs(server_start - previous['server_start']) > SERVER_START_TOLERANCE)
+
+    samples = {}
+    derived_values = []
+    for key, values in zip(series, field_values):
+        sample = [None if values[i] is None else cast(values[i]) for i, cast in zip(counters, casts)]
+        samples[key] = sample
+        last = previous['samples'].get(key) if previous is not None else None
+        if last is None:
+            deltas = [None]*len(sample)
+        else:
+            reset = restarted or any(x is not None and y is not None and x < y for x, y in zip(sample, last))
+            deltas = [x if reset else None if x is None or y is None else x - y for x, y in zip(sample, last)]
+        rates = [float(x)/elapsed if x is not None and elapsed > 0 else None for x in deltas]
+        derived_values.append([values[i] for i in kept] + deltas + rates)
+    all_counters[name] = { 'time': now, 'server_start': server_start, 'samples': samples }
+
+    derived_keys = ([field_keys[i] for i in kept] + [field_keys[i] + '_delta' for i in counters] +
+                    [field_keys[i] + '_rate' for i in counters])
+    derived_types = [field_types[i] for i in kept] + [field_types[i] for i in counters] + ['float']*len(counters)
+    return derived_keys, derived_values, derived_types
+
+CAPABILITY_VARIABLES = ['version', 'hostname', 'server_id', 'slow_query_log', 'query_response_time_stats', 'userstat']
+CAPABILITY_FLAGS = ['slow_query_log', 'query_response_time_stats', 'userstat']
+SERVER_START_TOLERANCE = 5
+
+def get_capabilities(cursor):
+    """ Returns a dictionary describing the DB version, whether each of the variables required by the
+        gather_* functions is on, the server ID and hostname, the time the server started and the
+        time the capabilities were fetched. All the variables are fetched with a single query.
+        Returns None if the DB version can't be obtained """
+    query = ('show global variables where Variable_name in (' +
+             ', '.join('\'' + x + '\'' for x in CAPABILITY_VARIABLES) + ')')
+    variables = dict(execute_query(cursor, query))
+    if 'version' not in variables:
+        journal_log.error('Failed to get DB version')
+        return None
+
+    capabilities = parse_version(variables['version'])
+    for variable in CAPABILITY_FLAGS:
+        capabilities[variable] = variables.get(variable) == 'ON'
+    capabilities['server_id'] = variables.get('server_id')
+    capabilities['hostname'] = variables.get('hostname')
+    capabilities['server_start'] = get_server_start(cursor)
+    capabilities['fetched_at'] = time.time()
+    return capabilities
+
+def parse_version(version):
     """ Returns a dictionary describing the DB version. Useful for queries 
         that are only valid on certain DB versions """
-    try:
-        version = cursor.execute('SELECT VERSION()')
-        version = cursor.fetchone()[0]
-    except MySQLdb.Warning as e:
-        journal_log.warning(e[0])
-    except MySQLdb.Error as e:
-        journal_log.error('Failed to get DB version - ' + e[1] + '(' + str(e[0]) + ')')
-        sys.exit(0)
-
     version_number = version.split('-')[0]
     versions = { 'major_version': int(version_number.split('.')[0]),
                  'minor_version': int(version_number.split('.')[1]),
@@ -200,48 +1192,307 @@ def get_version(cursor):
                }
     return versions
 
-def variable_is_on(cursor, variable):
-    """ Returns a boolean describing whether a variable is on. Returns false 
-        if the varaible doesn't exist. Useful for checking whether it is worth
-        executing a query """
-    query = 'show variables like \'' + variable + '\''
-    data = execute_query(cursor, query)
-
+def get_server_start(cursor):
+    """ Returns the time the server started as seconds since the epoch, worked out from its uptime.
+        Returns None if the uptime can't be obtained """
+    data = execute_query(cursor, 'show global status like \'Uptime\'')
     try:
-        value = data[0][1]
-    except IndexError:
-        value = None
+        return time.time() - int(data[0][1])
+    except (IndexError, ValueError):
+        return None
 
-    if value == 'ON':
-        return True
-    else:
-        return False
-
-def execute_query(cursor, query):
+def execute_query(cursor, query, params=None):
     """ Tries to execute the query on the DB and fetch the data. Returns an empty
         list in the case of error. Doesn't exit the script so that other metrics can
-        be collected even if one query fails """
+        be collected even if one query fails. If params is given, it is passed to
+        cursor.execute to be escaped and substituted into the %s placeholders in query """
     try:
-        cursor.execute(query)
+        cursor.execute(query, params)
     except MySQLdb.Warning as e:
-        journal_log.warning(e[0])
+        journal_log.warning(e.args[0])
     except MySQLdb.Error as e:
-        journal_log.error('Failed to execute query [' + query + '] - ' + e[1] + '(' + str(e[0]) + ')')
+        journal_log.error('Failed to execute query [' + query + '] - ' + e.args[1] + '(' + str(e.args[0]) + ')')
+        count_error()
         return []
 
     try:
         data = cursor.fetchall()
     except MySQLdb.Warning as e:
-        journal_log.warning(e[0])
+        journal_log.warning(e.args[0])
     except MySQLdb.Error as e:
-        journal_log.error('Failed to fetch data for query [' + query + '] - ' + e[1] + '(' + str(e[0]) + ')')
+        journal_log.error('Failed to fetch data for query [' + query + '] - ' + e.args[1] + '(' + str(e.args[0]) + ')')
+        count_error()
         return []
 
+    count_rows(len(data))
     return data
 
-def print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, field_values, field_types, ts_field=None, ts_format=None, increment_ts=False):
+STREAM_CHUNK_SIZE = 500
+
+def execute_streaming(cursor, query, params=None, max_rows=None, chunk_size=STREAM_CHUNK_SIZE):
+    """ Like execute_query, but yields the rows in lists of at most chunk_size rows as they are fetched. An
+        unbuffered SSCursor on the cursor's connection is used, so the rows are streamed from the server
+        rather than all loaded into memory first. At most max_rows rows are yielded, if the query returns
+        more the result is counted as truncated (see count_truncated). The query should have a LIMIT of
+        max_rows + 1 so that the server doesn't send rows that would only be read and thrown away. The
+        caller must consume all the chunks before running another query on the connection """
+    stream = cursor.connection.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        try:
+            stream.execute(query, params)
+        except MySQLdb.Warning as e:
+            journal_log.warning(e.args[0])
+        except MySQLdb.Error as e:
+            journal_log.error('Failed to execute query [' + query + '] - ' + e.args[1] + '(' + str(e.args[0]) + ')')
+            count_error()
+            return
+
+        rows = 0
+        try:
+            while max_rows is None or rows < max_rows:
+                chunk = stream.fetchmany(chunk_size if max_rows is None else min(chunk_size, max_rows - rows))
+                if not chunk:
+                    break
+                rows += len(chunk)
+                count_rows(len(chunk))
+                yield list(chunk)
+                # Write out what the caller wrote for the chunk, so memory use doesn't grow with the rows
+                flush_output()
+            else:
+                # The rest of the rows have to be read before the connection can be used again
+                if stream.fetchall():
+                    journal_log.warning('Result of query [' + query + '] truncated to ' + str(max_rows) + ' rows')
+                    count_truncated()
+        except MySQLdb.Warning as e:
+            journal_log.warning(e.args[0])
+        except MySQLdb.Error as e:
+            journal_log.error('Failed to fetch data for query [' + query + '] - ' + e.args[1] + '(' + str(e.args[0]) + ')')
+            count_error()
+    finally:
+        stream.close()
+
+collector_stats = threading.local()
+
+def count_rows(rows):
+    """ Adds to the number of rows fetched by the current collector, for the mysql_collector measurement """
+    counts = getattr(collector_stats, 'counts', None)
+    if counts is not None:
+        counts['rows'] += rows
+
+def count_error():
+    """ Adds to the number of errors in the current collector, for the mysql_collector measurement """
+    counts = getattr(collector_stats, 'counts', None)
+    if counts is not None:
+        counts['errors'] += 1
+
+def count_truncated():
+    """ Adds to the number of results cut short by --max-rows in the current collector, for the mysql_collector
+        measurement """
+    counts = getattr(collector_stats, 'counts', None)
+    if counts is not None:
+        counts['truncated'] += 1
+
+SLOW_LOG_READ_SIZE = 1024*1024
+SLOW_LOG_SERVER_HEADER = re.compile(r'^(.+, Version: .+ started with:|Tcp port: .*|Time\s+Id\s+Command\s+Argument)$')
+SLOW_LOG_HEADER_FIELD = re.compile(r'(\w+): +(?!\w+:)(\S+)')
+SLOW_LOG_SET = re.compile(r'^SET (?:\w+=\d+,)*timestamp=(\d+);$')
+
+def read_slow_log_entries(f, offset, max_bytes):
+    """ Reads slow log entries from the file object f, starting at offset and reading at most max_bytes.
+        Yields a tuple of a list of entries and the offset after the last of those entries, where each entry
+        is a list of the lines (without line endings) in the entry. The entry being read at the end of the
+        data is only yielded once the next entry has started, or if it is at the end of the file and its
+        last line ends in ';' (the server writes a ';' after the query text), so that an entry that the
+        server is still writing is left to be read by the next collection. An entry bigger than max_bytes
+        (e.g. a multi-MB extended INSERT) can never be read whole, so it is skipped, yielding no entries
+        and the offset of the next entry, and logged and counted as an error """
+    data = b''
+    read = 0
+    eof = False
+    yielded = False
+    while not eof and read < max_bytes:
+        chunk = f.read(min(SLOW_LOG_READ_SIZE, max_bytes - read))
+        if not chunk:
+            eof = True
+        read += len(chunk)
+        data += chunk
+
+        lines = data[:data.rfind(b'\n') + 1].splitlines(True)
+        entries, starts = split_slow_log_entries(lines)
+        if not entries:
+            continue
+
+        # Drop the last entry unless it is known to be complete
+        consumed = sum(len(x) for x in lines[:starts[-1]])
+        if eof and lines[-1].rstrip().endswith(b';'):
+            consumed = sum(len(x) for x in lines)
+        else:
+            entries = entries[:-1]
+
+        data = data[consumed:]
+        offset += consumed
+        if entries:
+            yielded = True
+            yield entries, offset
+
+    if not eof and not yielded and data:
+        # Otherwise the same part of the entry would be read every collection, and nothing after it
+        next_offset = skip_slow_log_entry(f, data, offset)
+        if next_offset is not None:
+            journal_log.error('Skipped slow log entry of ' + str(next_offset - offset) + ' bytes at offset ' + str(offset) +
+                              ' as it is bigger than --slow-log-max-bytes')
+            count_error()
+            yield [], next_offset
+
+def skip_slow_log_entry(f, data, offset):
+    """ Skips the slow log entry at the start of data, which starts at offset and continues in the file
+        object f, by reading f in chunks until the next entry starts. Returns the offset of the next
+        entry, or of the end of the file if the entry is the last and is complete, otherwise None """
+    # Skip the entry's own header lines, so its '# User@Host:' line isn't taken for the next entry
+    start = 0
+    while data[start:start + 1] == b'#' and data.find(b'\n', start) >= 0:
+        start = data.find(b'\n', start) + 1
+
+    skipped = 0
+    while True:
+        found = [x for x in (data.find(b'\n# Time:', start), data.find(b'\n# User@Host:', start)) if x >= 0]
+        if found:
+            return offset + skipped + min(found) + 1
+        # Keep enough of the end of the data to find a header split across chunks
+        drop = max(0, len(data) - len(b'\n# User@Host:'))
+        skipped += drop
+        data = data[drop:]
+        start = max(0, start - drop)
+        chunk = f.read(SLOW_LOG_READ_SIZE)
+        if not chunk:
+            return offset + skipped + len(data) if data.rstrip().endswith(b';') else None
+        data += chunk
+
+def split_slow_log_entries(lines):
+    """ Splits the lines of the slow log into entries. Returns a list of entries, where each entry is a
+        list of its lines (without line endings), and a list of the index in lines that each entry starts at.
+        Each entry starts with a '# Time:' line, or with a '# User@Host:' line as '# Time:' is omitted if it
+        would be the same as for the previous entry. Lines before the first entry and the header lines the
+        server writes to the file on startup or when it is flushed are ignored """
+    entries = []
+    starts = []
+    for i, line in enumerate(lines):
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        line = line.rstrip('\r\n')
+
+        if (line.startswith('# Time:') or
+           (line.startswith('# User@Host:') and not (entries and entries[-1][-1].startswith('# Time:')))):
+            entries.append([])
+            starts.append(i)
+        if entries and not SLOW_LOG_SERVER_HEADER.match(line):
+            entries[-1].append(line)
+
+    return entries, starts
+
+def parse_slow_log_entry(lines, server_id):
+    """ Parses the lines of a slow log entry into a list of values for the fields in SLOW_LOG_FIELD_KEYS,
+        converted to the same types as the corresponding columns in mysql.slow_log (the file only has the
+        time in seconds of the query, so e.g. query_time is converted to a timedelta). The start time is
+        given by 'SET timestamp=' in whole seconds. MySQL 5.7 and later also log the time the query was
+        logged with microseconds in the '# Time:' line, and if that agrees, the start time is worked out
+        from it and query_time so that it has microseconds like the start_time column. MySQL does not
+        repeat 'use <db>;' if the DB is the same as for the previous entry, so if the DB isn't given db is
+        None. Returns None if the entry can't be parsed """
+    header = {}
+    user_host = None
+    timestamp = None
+    log_time = None
+    db = None
+    sql_text = []
+    for line in lines:
+        if line.startswith('# Time:'):
+            log_time = parse_slow_log_time(line[len('# Time:'):].strip())
+        elif line.startswith('# User@Host:'):
+            user_host = line[len('# User@Host:'):].split('  Id:')[0].strip()
+        elif line.startswith('# administrator command:') and not sql_text:
+            sql_text.append(line[2:])
+        elif line.startswith('#') and not sql_text:
+            header.update(SLOW_LOG_HEADER_FIELD.findall(line))
+        elif line.startswith('use ') and line.endswith(';') and not sql_text and timestamp is None:
+            db = line[4:-1]
+        elif SLOW_LOG_SET.match(line) and not sql_text and timestamp is None:
+            timestamp = int(SLOW_LOG_SET.match(line).group(1))
+            header.update(re.findall(r'(\w+)=(\d+)', line))
+        else:
+            sql_text.append(line)
+
+    if 'Query_time' not in header or timestamp is None:
+        return None
+    sql_text = '\n'.join(sql_text).rstrip()
+    if sql_text.endswith(';'):
+        sql_text = sql_text[:-1]
+
+    try:
+        query_time = datetime.timedelta(seconds=float(header['Query_time']))
+        start_time = datetime.datetime.fromtimestamp(timestamp)
+        if log_time is not None:
+            start = log_time - (query_time.days*86400 + query_time.seconds)*(10**6) - query_time.microseconds
+            if start//(10**6) == timestamp:
+                start_time += datetime.timedelta(microseconds=start % (10**6))
+        return [start_time,
+                user_host,
+                query_time,
+                datetime.timedelta(seconds=float(header.get('Lock_time', 0))),
+                int(header.get('Rows_sent', 0)),
+                int(header.get('Rows_examined', 0)),
+                db if db is not None else header.get('Schema'),
+                int(header.get('last_insert_id', 0)),
+                int(header.get('insert_id', 0)),
+                int(server_id) if server_id is not None else 0,
+                sql_text]
+    except ValueError:
+        return None
+
+SLOW_LOG_ISO_TIME = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(Z|[+-]\d\d:\d\d)$')
+
+def parse_slow_log_time(value):
+    """ Returns the time in a '# Time:' line of the slow log as microseconds since the epoch, if it is in the
+        format used by MySQL 5.7 and later e.g. 2017-10-05T14:03:12.123456Z. Returns None for the older
+        format (e.g. 171005 14:03:12), which has no time zone or microseconds """
+    match = SLOW_LOG_ISO_TIME.match(value)
+    if match is None:
+        return None
+    seconds = calendar.timegm(tuple(int(x) for x in match.group(1, 2, 3, 4, 5, 6)))
+    zone = match.group(8)
+    if zone != 'Z':
+        seconds -= (1 if zone[0] == '+' else -1)*(int(zone[1:3])*3600 + int(zone[4:6])*60)
+    return seconds*(10**6) + int((match.group(7) or '0').ljust(6, '0'))
+
+def separate_start_times(state, field_values):
+    """ mysql_slow points are only tagged with the host, so slow queries that started in the same
+        millisecond (the precision Telegraf is set to) would have the same timestamp and overwrite each
+        other in InfluxDB. This is common in slow log files, as before MySQL 5.7 the start time is only in
+        whole seconds. Like increment_ts, returns a list of the number of ms to add to the timestamp of
+        each query's point, which is 1ms more for each query before it with the same start time, counting
+        those in previous collections. The start_time field itself is left as it is. The number of queries
+        seen with each start time is kept in the target state, for the latest SLOW_LOG_START_TIMES_KEPT
+        start times """
+    counts = state.setdefault('slow_log_start_times', {})
+    offsets = []
+    for values in field_values:
+        key = values[0].strftime('%Y-%m-%d %H:%M:%S.') + '%03d' % (values[0].microsecond//1000)
+        seen = counts.get(key, 0)
+        counts[key] = seen + 1
+        offsets.append(seen)
+    if len(counts) > SLOW_LOG_START_TIMES_KEPT:
+        for key in sorted(counts)[:-SLOW_LOG_START_TIMES_KEPT]:
+            del counts[key]
+    return offsets
+
+SLOW_LOG_START_TIMES_KEPT = 1000
+
+def print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, field_values, field_types, ts_field=None, ts_format=None, increment_ts=False,
+                               first_index=0, ts_offsets=None):
     """ Prints metrics in Influx line protocol format https://docs.influxdata.com/influxdb/v1.3/write_protocols/line_protocol_tutorial/
-        for the Telegraf exec plugin to output to InfluxDB. Each line printed is a point to be written to InfluxDB.
+        for the Telegraf exec plugin to output to InfluxDB. Each line printed is a point to be written to InfluxDB. All the points
+        are encoded by the LineProtocolEncoder for the measurement schema then written to stdout in a single write. Tags or fields
+        with a value of None (NULL in the DB) are left out of the point, and a point with no fields is not written.
 
         Arguments:
         measurement  -- the InfluxDB measurement to write to
@@ -254,53 +1505,508 @@ def print_influx_line_protocol(measurement, tag_keys, tag_values, field_keys, fi
         field_values -- a 2D list of the field values to be written. The first index is the point to be written and the second index is
                         the field e.g. if writing 2 points and using the field_keys ['waiting_thread','waiting_query'], field_values could
                         be [[12001,'select * from *'],[12002,'select * from *']]
-        field_types  -- a list of strings specifying the type of each field. Valid string values are 'string', 'integer' and 'float'
+        field_types  -- a list of strings specifying the type of each field. Valid string values are 'string', 'integer', 'float' and 'boolean'
         ts_field     -- a string, if you want to use one of the fields returned by the query as the timestamp in InfluxDB, specify the field name here
         ts_format    -- a string, if the field specified by ts_field isn't a datetime object, ts_format specifies the format to use when converting it
                         into a datetime object. See https://docs.python.org/2/library/datetime.html#strftime-strptime-behavior
         increment_ts -- a boolean, if there are multiple measurements with the same name, tags, fields and timestamp they overwrite
                         each other in InfluxDB. This adds 1ms to the timestamp to avoid this. This is useful when collecting event-based metrics
-                        e.g. blocking sessions. For this setting to work it requires precision = '1ms' in the Telegraf configuration """
+                        e.g. blocking sessions. For this setting to work it requires precision = '1ms' in the Telegraf configuration
+        first_index  -- an integer, the number of points already written by earlier calls when writing a result in chunks with
+                        increment_ts, so that the timestamps carry on from where the last chunk left off
+        ts_offsets   -- a list of integers, the number of ms to add to the timestamp of each point. Like increment_ts, but for when
+                        only some points would overwrite others, e.g. slow queries that started in the same ms """
+    encoder = get_encoder(measurement, tag_keys, field_keys, field_types)
     timestamp = int(time.time())*(10**9)
-    epoch = datetime.datetime.utcfromtimestamp(0)
     if ts_field != None:
         ts_index = field_keys.index(ts_field)
 
-    for i,val in enumerate(field_values):
+    per_point_tags = any(isinstance(x, list) for x in tag_values)
+    if not per_point_tags:
+        tags = encoder.encode_tags(tag_values)
+
+    lines = []
+    for i, values in enumerate(field_values):
         if ts_format != None:
-            ts_datetime = datetime.strptime(field_values[i][ts_index], ts_format)
-            timestamp = int((ts_datetime - epoch).total_seconds()*(10**9))
+            timestamp = datetime_to_ns(datetime.datetime.strptime(values[ts_index], ts_format))
         elif ts_field != None:
-            timestamp = int((field_values[i][ts_index] - epoch).total_seconds()*(10**9))
-        if increment_ts:
-            timestamp = timestamp + i*(10**6)
-        tags = ilp_join_tags(tag_keys, tag_values, i)
-        fields = ilp_join_fields(field_keys, field_values[i], field_types)
-        print measurement + ',' + ','.join(tags) + ' ' + ','.join(fields) + ' ' + str(timestamp)
-
-def ilp_join_tags(keys, values, index):
-    """ Joins tag keys and values together in Influx line protocol format. Handles both cases where there is
-        one tag value for all points and where there is a tag value for each point """
-    joined_tags = []
-    for i, key in enumerate(keys):
-        if isinstance(values[i], list):
-            joined_tags.append(key + '=' + str(values[i][index]))
-        else:
-            joined_tags.append(key + '=' + str(values[i]))
-    return joined_tags
-
-def ilp_join_fields(keys, values, types):
-    """ Joins field keys and values together in Influx line protocol format. Handles fields differently
-        depending on their type"""
-    joined_fields = []
-    for i, val in enumerate(keys):
-        if types[i] == 'integer':
-            joined_fields.append(keys[i] + '=' + str(values[i]) + 'i')
-        elif types[i] == 'string':
-            joined_fields.append(keys[i] + '=' + '"' + str(values[i]) + '"')
+            timestamp = datetime_to_ns(values[ts_index])
+        if per_point_tags:
+            tags = encoder.encode_tags([x[i] if isinstance(x, list) else x for x in tag_values])
+        point_timestamp = timestamp + (first_index + i)*(10**6) if increment_ts else timestamp
+        if ts_offsets is not None:
+            point_timestamp += ts_offsets[i]*(10**6)
+        line = encoder.encode(tags, values, point_timestamp)
+        if line is not None:
+            lines.append(line)
+
+    write_output(''.join(lines))
+
+output_buffer = threading.local()
+output_lock = threading.Lock()
+
+def write_output(data):
+    """ Writes a batch of line protocol to stdout, or to the spool if --spool-dir is given, or if
+        called from a CollectorThread, adds it to the thread's output to be written by flush_output.
+        Batches from different threads are never interleaved """
+    if data:
+        lines = getattr(output_buffer, 'lines', None)
+        if lines is not None:
+            lines.append(data)
         else:
-            joined_fields.append(keys[i] + '=' + str(values[i]))
-    return joined_fields  
+            with output_lock:
+                write_locked(data)
+
+def flush_output(lines=None, counts=None):
+    """ Writes out and empties the output buffered by a CollectorThread, by default the current one's,
+        adding the number of bytes written to its counts. Does nothing if not called from a
+        CollectorThread """
+    if lines is None:
+        lines = getattr(output_buffer, 'lines', None)
+        counts = getattr(collector_stats, 'counts', None)
+        if lines is None:
+            return
+    with output_lock:
+        data = ''.join(lines)
+        del lines[:]
+        if counts is not None:
+            counts['bytes'] += len(data)
+        if data:
+            write_locked(data)
+
+def write_locked(data):
+    """ Writes data to the spool if there is one, or to stdout. The caller must hold output_lock """
+    if spool is not None:
+        try:
+            spool.append(data)
+            return
+        except (IOError, OSError) as e:
+            journal_log.error('Failed to write to spool, writing to stdout instead - ' + str(e))
+    sys.stdout.write(data)
+
+# The spool used by write_output, and the function flush_spool sends its batches to, set up by main
+spool = None
+spool_sink = None
+
+# Each frame in a spool segment is the length and CRC32 of its data followed by the data
+SPOOL_FRAME_HEADER = struct.Struct('>II')
+
+class Spool(object):
+    """ An on-disk queue of line protocol batches, so that points aren't lost if they can't be
+        written out straight away, e.g. Telegraf is slow to read stdout or the exec plugin times out,
+        or InfluxDB is down. Batches are appended as frames to segment files in directory, and are
+        synced to disk before the target state (e.g. the slow log cursor) is saved. Each process
+        appends to a new segment, which is rotated once it's segment_bytes long, so a frame left half
+        written by a crash is never followed by good ones. flush reads the frames after the
+        checkpoint by memory-mapping the segments, and moves the checkpoint on once they've been
+        sent. A process holds a lock on the segment it is appending to until it rotates it or exits,
+        and a sent segment is only deleted once its lock is free, so frames appended by an overlapping
+        run aren't lost. If the spool grows beyond max_bytes the oldest segments that aren't being
+        appended to are deleted, losing their points, so that an outage can't fill the disk """
+
+    def __init__(self, directory, segment_bytes, max_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.checkpoint_path = os.path.join(directory, 'checkpoint.json')
+        self.segment = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, '%016d.seg' % number)
+
+    def segments(self):
+        """ Returns the numbers of the segments in the spool, oldest first """
+        return sorted(int(x[:-4]) for x in os.listdir(self.directory) if x.endswith('.seg') and x[:-4].isdigit())
+
+    def append(self, data):
+        """ Appends a batch of line protocol to the spool as a frame, and syncs it to disk """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        frame = SPOOL_FRAME_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+        with open(os.path.join(self.directory, 'append.lock'), 'a') as lock:
+            # Other processes (e.g. an exec run that overran) may be appending to the same spool
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            segments = self.segments()
+            if self.segment is not None and self.segment.tell() + len(frame) > self.segment_bytes:
+                self.segment.close()
+                self.segment = None
+            self.drop_segments(segments, len(frame))
+            if self.segment is None:
+                # Locked while still holding append.lock, so a flush never sees the new segment unlocked
+                self.segment = open(self.segment_path(segments[-1] + 1 if segments else 0), 'ab')
+                fcntl.flock(self.segment, fcntl.LOCK_EX)
+            self.segment.write(frame)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+
+    def drop_segments(self, segments, needed):
+        """ Deletes the oldest segments, other than those being appended to, until there is room for
+            needed more bytes without the spool growing beyond --spool-max-bytes """
+        current = os.path.basename(self.segment.name) if self.segment is not None else None
+        sizes = [(x, os.path.getsize(self.segment_path(x))) for x in segments]
+        total = sum(x[1] for x in sizes)
+        for number, size in sizes:
+            if total + needed <= self.max_bytes or os.path.basename(self.segment_path(number)) == current:
+                break
+            finished = self.lock_finished_segment(number)
+            if finished is None:
+                continue
+            with finished:
+                journal_log.warning('Spool is full, dropping ' + str(size) + ' bytes of unsent points in segment ' + str(number))
+                remove_file(self.segment_path(number))
+            total -= size
+
+    def lock_finished_segment(self, number):
+        """ Returns the segment opened and locked if no process is appending to it any more, otherwise
+            None. Deleting the segment while holding the lock is safe, as appenders never reopen one """
+        try:
+            f = open(self.segment_path(number), 'rb')
+        except IOError:
+            return None
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+        return f
+
+    def read_frames(self, number, offset):
+        """ Yields the end offset and data of each complete frame in a segment after offset. Stops
+            at a frame that is incomplete, i.e. still being written or left half written by a crash,
+            or whose CRC doesn't match """
+        try:
+            f = open(self.segment_path(number), 'rb')
+        except IOError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                while offset + SPOOL_FRAME_HEADER.size <= size:
+                    length, crc = SPOOL_FRAME_HEADER.unpack_from(data, offset)
+                    start = offset + SPOOL_FRAME_HEADER.size
+                    if start + length > size:
+                        break
+                    frame = data[start:start + length]
+                    if zlib.crc32(frame) & 0xffffffff != crc:
+                        journal_log.error('Corrupt frame at offset ' + str(offset) + ' in spool segment ' + str(number))
+                        break
+                    offset = start + length
+                    yield offset, frame
+            finally:
+                data.close()
+
+    def flush(self, send, batch_bytes, timeout):
+        """ Sends the frames after the checkpoint, in batches of about batch_bytes, by calling send with
+            each batch. send returns the number of bytes of the batch it sent, which is less than all of
+            them if it couldn't send the rest (e.g. InfluxDB is down), in which case flushing stops and
+            the frames not completely sent are retried by the next flush. Also stops after timeout
+            seconds, so a slow reader holds up the next collection by at most that long. Only one
+            process flushes the spool at a time, others return straight away """
+        deadline = time.time() + timeout
+        with open(os.path.join(self.directory, 'flush.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                journal_log.info('Spool is already being flushed')
+                return
+
+            checkpoint = load_state(self.checkpoint_path)
+            segments = self.segments()
+            for number in segments:
+                if number < checkpoint.get('segment', -1):
+                    continue
+                # The newest segment is always kept, so that new segments are numbered after the checkpoint
+                finished = self.lock_finished_segment(number) if number != segments[-1] else None
+                try:
+                    offset = checkpoint['offset'] if number == checkpoint.get('segment') else 0
+                    batch = []
+                    batch_size = 0
+                    for end, frame in self.read_frames(number, offset):
+                        batch.append((end, frame))
+                        batch_size += len(frame)
+                        if batch_size >= batch_bytes:
+                            if not self.send_batch(send, batch, number, deadline):
+                                return
+                            batch = []
+                            batch_size = 0
+                    if batch and not self.send_batch(send, batch, number, deadline):
+                        return
+                    # A segment still being appended to (e.g. by an exec run that overran) may get more
+                    # frames, so it and the ones after it are left for a later flush
+                    if finished is None:
+                        return
+                    self.save_checkpoint(number + 1, 0)
+                    remove_file(self.segment_path(number))
+                finally:
+                    if finished is not None:
+                        finished.close()
+
+    def send_batch(self, send, batch, number, deadline):
+        """ Sends a batch of (end offset, frame) from a segment and moves the checkpoint to the end of the
+            last frame completely sent. Returns False if it couldn't all be sent or the flush has run out
+            of time """
+        remaining = deadline - time.time()
+        data = b''.join(x[1] for x in batch)
+        sent = send(data, remaining) if remaining > 0 else 0
+        offset = None
+        for end, frame in batch:
+            if sent < len(frame):
+                break
+            sent -= len(frame)
+            offset = end
+        if offset is not None:
+            self.save_checkpoint(number, offset)
+        if offset != batch[-1][0]:
+            journal_log.warning('Stopped flushing spool, unsent points are kept for the next flush')
+            return False
+        return True
+
+    def save_checkpoint(self, number, offset):
+        save_state(self.checkpoint_path, { 'segment': number, 'offset': offset })
+
+def remove_file(path):
+    """ Deletes a file, ignoring errors as another process may have deleted it first """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def flush_spool():
+    """ Sends the points in the spool to the sink chosen with --flush-to, if --spool-dir is given """
+    if spool is not None:
+        try:
+            spool.flush(spool_sink, options.flush_batch_bytes, options.flush_timeout)
+        except (IOError, OSError) as e:
+            journal_log.error('Failed to flush spool - ' + str(e))
+
+class StdoutWriter(object):
+    """ Writes batches of line protocol to stdout, for --flush-to stdout. Called by Spool.flush. stdout
+        is made non-blocking and written a slice of at most PIPE_BUF bytes at a time, once select says
+        there is room, so a reader (e.g. Telegraf) that stops reading holds up a flush for at most its
+        timeout. If a batch is cut off part way through a line, a newline is written before the next
+        batch so that the line it is retried in isn't mangled """
+
+    def __init__(self):
+        self.partial_line = False
+
+    def __call__(self, data, timeout):
+        """ Returns the number of bytes of data written within timeout seconds """
+        deadline = time.time() + timeout
+        prefix = b'\n' if self.partial_line else b''
+        data = prefix + data
+        sys.stdout.flush()
+        fd = sys.stdout.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        written = 0
+        try:
+            while written < len(data):
+                remaining = deadline - time.time()
+                if remaining <= 0 or not select.select([], [fd], [], remaining)[1]:
+                    break
+                try:
+                    written += os.write(fd, data[written:written + select.PIPE_BUF])
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        finally:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+        if written:
+            self.partial_line = data[written - 1:written] != b'\n'
+        return max(0, written - len(prefix))
+
+class InfluxDBWriter(object):
+    """ Writes batches of line protocol straight to the InfluxDB HTTP write API, gzipped, for
+        --flush-to influxdb. Called by Spool.flush """
+
+    def __init__(self, url, database, retention_policy=None, user=None, password=None):
+        params = [('db', database), ('precision', 'ns')]
+        if retention_policy:
+            params.append(('rp', retention_policy))
+        if user:
+            params += [('u', user), ('p', password or '')]
+        self.url = url.rstrip('/') + '/write?' + urlencode(params)
+
+    def __call__(self, data, timeout):
+        """ Returns the number of bytes of data written, all or none of them """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(data) + compressor.flush()
+        request = urllib_request.Request(self.url, body, { 'Content-Encoding': 'gzip',
+                                                           'Content-Type': 'text/plain; charset=utf-8' })
+        try:
+            urllib_request.urlopen(request, timeout=timeout).close()
+        except HTTPError as e:
+            # Retrying a batch InfluxDB has rejected (e.g. a field type conflict) would block the
+            # spool for good, so it's dropped, unless InfluxDB is just overloaded or unavailable
+            if e.code < 500 and e.code not in (408, 429):
+                journal_log.error('InfluxDB rejected ' + str(len(data)) + ' bytes of points - ' + str(e.code) + ' ' + e.read().decode('utf-8', 'replace').strip())
+                return len(data)
+            journal_log.error('Failed to write points to InfluxDB - ' + str(e.code))
+            return 0
+        except (URLError, IOError) as e:
+            journal_log.error('Failed to write points to InfluxDB - ' + str(e))
+            return 0
+        return len(data)
+
+EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+def datetime_to_ns(value):
+    """ Converts a naive datetime, taken to be in UTC, to nanoseconds since the epoch. Uses integer
+        arithmetic so that microseconds aren't lost to floating point rounding """
+    delta = value - EPOCH
+    return ((delta.days*86400 + delta.seconds)*(10**6) + delta.microseconds)*(10**3)
+
+_encoders = {}
+
+def get_encoder(measurement, tag_keys, field_keys, field_types):
+    """ Returns the LineProtocolEncoder for the measurement schema, creating it the first time the
+        schema is used """
+    schema = (measurement, tuple(tag_keys), tuple(field_keys), tuple(field_types))
+    try:
+        return _encoders[schema]
+    except KeyError:
+        encoder = _encoders[schema] = LineProtocolEncoder(measurement, tag_keys, field_keys, field_types)
+        return encoder
+
+class LineProtocolEncoder(object):
+    """ Encodes points with the same measurement, tag keys, field keys and field types in Influx line
+        protocol. When the encoder is created the escaped measurement and keys are worked out, and a
+        function specialised to the schema is compiled that formats every field of a point with a single
+        string format operation. Points with NULL fields, or float fields that are NaN or infinite, fall
+        back to formatting each field in turn so those fields can be left out. Measurements, keys, tag
+        values and string field values are escaped, so values containing commas, spaces, equals signs,
+        quotes, backslashes or newlines (e.g. SQL text) are written correctly """
+
+    def __init__(self, measurement, tag_keys, field_keys, field_types):
+        self.measurement = escape_measurement(measurement)
+        self.tag_prefixes = [',' + escape_key(x) + '=' for x in tag_keys]
+        self.fields = [(escape_key(k) + '=', FIELD_FORMATTERS[t]) for k, t in zip(field_keys, field_types)]
+        self.encode = self.compile_encode(field_types)
+
+    def compile_encode(self, field_types):
+        """ Returns a function equivalent to encode_fields, specialised to the field types """
+        template = []
+        args = []
+        float_checks = []
+        for i, ((prefix, formatter), field_type) in enumerate(zip(self.fields, field_types)):
+            if field_type == 'string':
+                template.append(prefix.replace('%', '%%') + '"%s"')
+                args.append('escape_string(values[%d])' % i)
+            elif field_type == 'integer':
+                template.append(prefix.replace('%', '%%') + '%di')
+                args.append('int(values[%d])' % i)
+            elif field_type == 'float':
+                template.append(prefix.replace('%', '%%') + '%s')
+                args.append('f%d' % i)
+                float_checks.append('    f%d = format_float(values[%d])\n'
+                                    '    if f%d is None:\n'
+                                    '        return encode_fields(tags, values, timestamp)\n' % (i, i, i))
+            else:
+                template.append(prefix.replace('%', '%%') + '%s')
+                args.append('format_boolean(values[%d])' % i)
+
+        source = ('def encode(tags, values, timestamp):\n'
+                  '    if None in values or len(values) < %d:\n'
+                  '        return encode_fields(tags, values, timestamp)\n'
+                  '%s'
+                  '    return %r %% (tags, %s timestamp)\n'
+                  % (len(self.fields), ''.join(float_checks), '%s ' + ','.join(template) + ' %d\n',
+                     ''.join(x + ', ' for x in args)))
+        namespace = { 'encode_fields': self.encode_fields,
+                      'escape_string': escape_string,
+                      'format_float': format_float,
+                      'format_boolean': format_boolean }
+        exec(compile(source, '<line protocol encoder for ' + self.measurement + '>', 'exec'), namespace)
+        return namespace['encode']
+
+    def encode_tags(self, tag_values):
+        """ Returns the measurement and tag set for a point with the given tag values, to be passed to
+            encode. Tags with a value of None or an empty value are left out """
+        tags = [self.measurement]
+        for prefix, value in zip(self.tag_prefixes, tag_values):
+            if value is not None:
+                value = escape_key(to_str(value))
+                if value:
+                    tags.append(prefix + value)
+        return ''.join(tags)
+
+    def encode_fields(self, tags, field_values, timestamp):
+        """ Returns a line (including the trailing newline) for the point with the measurement and tag
+            set tags (as returned by encode_tags), the given field values and the timestamp in ns. Fields
+            with a value of None are left out, returns None if there are no fields left. encode is the
+            same but faster """
+        fields = []
+        for (prefix, formatter), value in zip(self.fields, field_values):
+            if value is not None:
+                value = formatter(value)
+                if value is not None:
+                    fields.append(prefix + value)
+        if not fields:
+            return None
+        return tags + ' ' + ','.join(fields) + ' ' + str(timestamp) + '\n'
+
+if str is bytes:
+    TEXT_TYPES = (str, unicode)
+
+    def to_str(value):
+        """ Converts a value to a str, encoding unicode as UTF-8 """
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+else:
+    TEXT_TYPES = (str, bytes)
+
+    def to_str(value):
+        """ Converts a value to a str, decoding bytes (e.g. BLOB columns) as UTF-8 """
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        return str(value)
+
+def escape_measurement(value):
+    """ Escapes a measurement name for line protocol """
+    return value.replace(',', '\\,').replace(' ', '\\ ').replace('\n', '\\n')
+
+def escape_key(value):
+    """ Escapes a tag key, tag value or field key for line protocol """
+    return value.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ').replace('\n', '\\n').replace('\r', '\\r')
+
+def escape_string(value):
+    """ Converts a string field value to a str, escaping backslashes, double quotes and newlines """
+    if type(value) is not str:
+        if not isinstance(value, TEXT_TYPES):
+            # Dates, times and numbers don't contain any characters that need escaping
+            return str(value)
+        value = to_str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+
+def format_string(value):
+    """ Formats a string field value """
+    return '"' + escape_string(value) + '"'
+
+def format_integer(value):
+    """ Formats an integer field value """
+    return str(int(value)) + 'i'
+
+def format_float(value):
+    """ Formats a float field value. Returns None for NaN and infinity, which can't be written to InfluxDB """
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return repr(value)
+
+def format_boolean(value):
+    """ Formats a boolean field value """
+    return 'true' if value else 'false'
+
+FIELD_FORMATTERS = { 'string': format_string,
+                     'integer': format_integer,
+                     'float': format_float,
+                     'boolean': format_boolean }
 
 if __name__ == "__main__":
     main()